@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from sqlite3 import connect
+from time import time
+
+class ArchiveQueue():
+    # persistent list of (app, depot, manifest) targets for depot_archiver's
+    # batch mode; a depot or manifest of 0 means "all depots"/"latest manifest"
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = connect(filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS targets (
+            appid INTEGER NOT NULL,
+            depotid INTEGER NOT NULL DEFAULT 0,
+            manifestid INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated REAL,
+            message TEXT,
+            UNIQUE (appid, depotid, manifestid))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS targets_status ON targets (status)")
+        # targets that were running when a previous run died get picked up again
+        self.db.execute("UPDATE targets SET status = 'pending' WHERE status = 'running'")
+        self.db.commit()
+    def __repr__(self):
+        counts = dict(self.db.execute("SELECT status, COUNT(*) FROM targets GROUP BY status").fetchall())
+        return f"Archive queue {self.filename}: " + ", ".join("%s %s" % (count, status) for status, count in sorted(counts.items()))
+    def add(self, appid, depotid=None, manifestid=None):
+        self.db.execute("INSERT OR IGNORE INTO targets (appid, depotid, manifestid, updated) VALUES (?, ?, ?, ?)",
+            (appid, depotid or 0, manifestid or 0, time()))
+    def import_file(self, filename):
+        # one target per line: appid [depotid [manifestid]], # starts a comment
+        added = self.db.total_changes
+        with open(filename, "r") as f:
+            for line in f:
+                line = line.split("#")[0].split()
+                if not line: continue
+                self.add(*(int(x) for x in line[:3]))
+        self.db.commit()
+        return self.db.total_changes - added
+    def retry_failed(self):
+        self.db.execute("UPDATE targets SET status = 'pending' WHERE status = 'failed'")
+        self.db.commit()
+    def take(self, limit):
+        # claim up to limit pending targets, returned as depot_archiver -a tuples
+        rows = self.db.execute("SELECT appid, depotid, manifestid FROM targets WHERE status = 'pending' ORDER BY rowid LIMIT ?", (limit,)).fetchall()
+        self.db.executemany("UPDATE targets SET status = 'running', attempts = attempts + 1, updated = ? WHERE appid = ? AND depotid = ? AND manifestid = ?",
+            [(time(), *row) for row in rows])
+        self.db.commit()
+        return [tuple(x for x in row if x) for row in rows]
+    def mark(self, target, success, message=None):
+        target = tuple(target) + (0,) * (3 - len(target))
+        self.db.execute("UPDATE targets SET status = ?, message = ?, updated = ? WHERE appid = ? AND depotid = ? AND manifestid = ?",
+            ("done" if success else "failed", message, time(), *target))
+        self.db.commit()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Show or add to a depot_archiver batch queue.')
+    parser.add_argument("queue", type=str, help="Path to the queue database")
+    parser.add_argument("-f", dest="files", help="Add the targets listed in this file (one 'appid [depotid [manifestid]]' per line); can be used multiple times", action="append")
+    parser.add_argument("--retry-failed", dest="retry_failed", help="Mark failed targets as pending again", action="store_true")
+    args = parser.parse_args()
+    queue = ArchiveQueue(args.queue)
+    for file in args.files or []:
+        print("added", queue.import_file(file), "targets from", file)
+    if args.retry_failed:
+        queue.retry_failed()
+    print(queue)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+from json import dump, load
+from os import path, replace
+from sys import argv
+from time import time
+
+# typical compressed chunk size, used to turn latency and throughput into an
+# expected time per request so servers can be compared with one number
+TYPICAL_CHUNK = 1024 * 1024
+
+class ServerScoreboard():
+    def __init__(self, filename="./cdn_scores.json", stripe=4, alpha=0.3, slow_factor=3):
+        self.filename = filename
+        self.stripe = stripe # number of best servers to spread requests across
+        self.alpha = alpha # weight of the newest sample in the moving averages
+        self.slow_factor = slow_factor # servers this many times slower than the best are demoted
+        self.scores = {}
+        self.picks = 0
+        if path.exists(filename):
+            with open(filename, "r") as f:
+                try:
+                    self.scores = load(f)
+                except ValueError:
+                    print("ignoring corrupt server scoreboard", filename)
+    def __repr__(self):
+        return "\n".join("%s: %s ms, %s MB/s, %s failures" % (host,
+            round(score["latency"] * 1000), round(score["throughput"] / 1000000, 2), score["failures"])
+            for host, score in sorted(self.scores.items(), key=lambda item: self.expected_time(item[0])))
+    @staticmethod
+    def host(server):
+        if type(server) == str: return server # server override URL
+        return "%s://%s:%s" % ("https" if server.https else "http", server.host, server.port)
+    def expected_time(self, host):
+        if not host in self.scores:
+            return 0 # unmeasured servers go first so they get measured
+        score = self.scores[host]
+        return score["latency"] + TYPICAL_CHUNK / max(score["throughput"], 1)
+    def record(self, host, latency, length, elapsed):
+        throughput = length / max(elapsed - latency, 0.001)
+        if not host in self.scores:
+            self.scores[host] = {"latency": latency, "throughput": throughput, "failures": 0, "penalty_until": 0}
+            return
+        score = self.scores[host]
+        score["latency"] += self.alpha * (latency - score["latency"])
+        score["throughput"] += self.alpha * (throughput - score["throughput"])
+    def record_failure(self, host, penalty=10):
+        if not host in self.scores:
+            self.scores[host] = {"latency": 1, "throughput": 1, "failures": 0, "penalty_until": 0}
+        score = self.scores[host]
+        score["failures"] += 1
+        score["latency"] *= 2
+        score["throughput"] /= 2
+        score["penalty_until"] = time() + penalty
+    def rank(self, servers):
+        now = time()
+        ranked = sorted(servers, key=lambda server: self.expected_time(self.host(server)))
+        available = [server for server in ranked if self.scores.get(self.host(server), {}).get("penalty_until", 0) <= now]
+        if not available:
+            return ranked
+        # demote servers that are much slower than the best one, even if they never fail
+        best = self.expected_time(self.host(available[0]))
+        fast = [server for server in available if not best or self.expected_time(self.host(server)) <= best * self.slow_factor]
+        return fast
+    def pick(self, servers):
+        # stripe requests round-robin across the best few servers
+        ranked = self.rank(servers)[:self.stripe]
+        self.picks += 1
+        return ranked[self.picks % len(ranked)]
+    def save(self):
+        with open(self.filename + ".tmp", "w") as f:
+            dump(self.scores, f, indent=1)
+        replace(self.filename + ".tmp", self.filename)
+
+if __name__ == "__main__":
+    print(ServerScoreboard(argv[1] if len(argv) > 1 else "./cdn_scores.json"))
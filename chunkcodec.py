@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+from hashlib import sha1
+from io import BytesIO
+from os.path import exists
+from struct import unpack
+from zipfile import ZipFile
+import lzma
+
+from steam.core.crypto import symmetric_decrypt
+
+def find_depot_key(depotid):
+    ## Using No-Intro's DepotKey format, which is
+    ## a 32-byte/256-bit binary file.
+    keyfile = "./keys/%s.depotkey" % depotid
+    if exists(keyfile):
+        with open(keyfile, "rb") as f:
+            return f.read()
+    ## If depotkey is not found, locate depot_keys.txt
+    ## and check if key is located in there.
+    if exists("./depot_keys.txt"):
+        with open("./depot_keys.txt", "r", encoding="utf-8") as f:
+            for line in f.read().split("\n"):
+                line = line.split("\t")
+                try:
+                    if int(line[0]) == int(depotid):
+                        return bytes.fromhex(line[2])
+                except (ValueError, IndexError):
+                    pass
+    return None
+
+def decompress_chunk(decrypted):
+    if decrypted[:2] == b'VZ': # LZMA
+        decompressed_size = unpack('<i', decrypted[-6:-2])[0]
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, decrypted[7:12])]).decompress(decrypted[12:-10])[:decompressed_size]
+    elif decrypted[:2] == b'PK': # Zip
+        zipfile = ZipFile(BytesIO(decrypted))
+        return zipfile.read(zipfile.filelist[0])
+    raise ValueError("unknown archive type %s" % decrypted[:2])
+
+def decode_chunk(data, depotkey=None):
+    # decrypt (if a key is given) and decompress a chunk as stored on the CDN
+    if depotkey:
+        data = symmetric_decrypt(data, depotkey)
+    return decompress_chunk(data)
+
+def verify_chunk(data, sha, depotkey=None):
+    # picklable entry point for process pools: True if the chunk decodes to
+    # data matching its sha1
+    try:
+        return sha1(decode_chunk(data, depotkey)).digest() == sha
+    except Exception:
+        return False
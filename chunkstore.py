@@ -1,15 +1,175 @@
 #!/usr/bin/env python3
+from array import array
 from binascii import hexlify, unhexlify
-from os import path
-from struct import iter_unpack, pack
-from sys import argv
+from bisect import bisect_left
+from collections.abc import Mapping
+from glob import glob
+from itertools import islice
+from mmap import mmap, ACCESS_READ
+from os import path, fstat, fsync, remove, replace
+from struct import iter_unpack, pack, unpack_from
+from sys import argv, byteorder
+from time import monotonic
+import os
+
+def copy_range(source, dest, source_offset, dest_offset, length):
+    # copy between two file descriptors inside the kernel where possible,
+    # falling back to reads and writes through python; returns bytes copied
+    copied = 0
+    while copied < length:
+        copied_now = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied_now = os.copy_file_range(source, dest, length - copied, source_offset + copied, dest_offset + copied)
+            except OSError: # e.g. across filesystems on older kernels
+                pass
+        if not copied_now:
+            os.lseek(source, source_offset + copied, os.SEEK_SET)
+            data = os.read(source, min(length - copied, 1024 * 1024))
+            if not data: break # source is shorter than expected
+            os.lseek(dest, dest_offset + copied, os.SEEK_SET)
+            copied_now = os.write(dest, data)
+        copied += copied_now
+    return copied
+
+def manifest_chunk_order(manifest):
+    # the shas of a DepotManifest's chunks in the order its files use them
+    # (duplicates included), for laying out chunkstores so that reading them
+    # back file by file is mostly sequential
+    for file in manifest.iter_files():
+        for chunk in sorted(file.chunks, key=lambda chunk: chunk.offset):
+            yield chunk.sha
+
+class ChunkIndex(Mapping):
+    # {sha: (offset, length)} mapping kept as the CSM's own 36-byte records,
+    # sorted by sha, so a store with millions of chunks doesn't need millions
+    # of tuples; lookups bisect an array of the first 8 bytes of every sha.
+    # Chunks added after loading, and a short unsorted tail of records (like
+    # the ones write_csm appends), go in a small dict on top
+    UNSORTED_SHARE = 8 # sort everything once more than 1 in 8 records are unsorted
+    def __init__(self, records=b""):
+        records = bytes(records[:len(records) - len(records) % 36])
+        keys = self.prefixes(records)
+        end = self.sorted_count(records, keys)
+        if (len(keys) - end) * self.UNSORTED_SHARE > len(keys):
+            records = self.sort(records, keys)
+            keys = self.prefixes(records)
+            end = len(keys)
+        self.records, self.prefix_keys, self.count = records[:end * 36], keys[:end], end
+        # about 64 records per bucket
+        self.bits = min(16, max(0, end.bit_length() - 6))
+        self.fanout = [bisect_left(self.prefix_keys, bucket << (64 - self.bits)) for bucket in range(1 << self.bits)] + [end]
+        self.added = {}
+        self.added_flags = {} # flags of added records, if not 0
+        self.shadowed = 0 # number of added chunks that replace a record
+        for sha, offset, flags, length in iter_unpack("<20s Q L L", records[end * 36:]):
+            if not sha in self: # the first record of a chunk wins
+                self.added[sha] = (offset, length)
+                if flags: self.added_flags[sha] = flags
+    @staticmethod
+    def prefixes(records):
+        # the first 8 bytes of every sha as integers that sort like the shas
+        prefixes = bytearray(len(records) // 36 * 8)
+        for i in range(8):
+            prefixes[i::8] = records[i::36]
+        keys = array("Q", prefixes)
+        if byteorder == "little":
+            keys.byteswap()
+        return keys
+    @staticmethod
+    def sorted_count(records, keys):
+        # number of records at the start that are in strictly ascending sha order
+        for i, (key, next_key) in enumerate(zip(keys, islice(keys, 1, None))):
+            if key > next_key or key == next_key and records[i * 36:i * 36 + 20] >= records[i * 36 + 36:i * 36 + 56]:
+                return i + 1
+        return len(keys)
+    @staticmethod
+    def sort(records, keys):
+        # sort records by sha, dropping all but the first record of each chunk
+        view = memoryview(records)
+        sorted_records = bytearray()
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            sorted_records += view[i * 36:i * 36 + 36]
+        sorted_records = bytes(sorted_records)
+        if ChunkIndex.sorted_count(sorted_records, ChunkIndex.prefixes(sorted_records)) == len(keys):
+            return sorted_records
+        # shas that share their first 8 bytes, in practice the same chunk listed twice
+        sorted_records, last = bytearray(), None
+        for i in sorted(range(len(keys)), key=lambda i: records[i * 36:i * 36 + 20]):
+            if records[i * 36:i * 36 + 20] != last:
+                sorted_records += view[i * 36:i * 36 + 36]
+                last = records[i * 36:i * 36 + 20]
+        return bytes(sorted_records)
+    def position(self, sha):
+        # index of the first record whose sha isn't less than sha; the fanout
+        # table narrows the search down to the records sharing sha's top bits
+        key = int.from_bytes(sha[:8], "big")
+        bucket = key >> (64 - self.bits)
+        i = bisect_left(self.prefix_keys, key, self.fanout[bucket], self.fanout[bucket + 1])
+        while i < self.count and self.prefix_keys[i] == key and self.records[i * 36:i * 36 + 20] < sha:
+            i += 1
+        return i
+    def find(self, sha):
+        i = self.position(sha)
+        if i < self.count and self.records[i * 36:i * 36 + 20] == sha:
+            return i
+        return -1
+    def __getitem__(self, sha):
+        if sha in self.added:
+            return self.added[sha]
+        i = self.find(sha)
+        if i < 0:
+            raise KeyError(sha)
+        _, offset, _, length = unpack_from("<20s Q L L", self.records, i * 36)
+        return offset, length
+    def __contains__(self, sha):
+        return sha in self.added or self.find(sha) >= 0
+    def flags(self, sha):
+        # the third field of a record, which CSMs always leave at 0
+        if sha in self.added:
+            return self.added_flags.get(sha, 0)
+        i = self.find(sha)
+        return unpack_from("<L", self.records, i * 36 + 28)[0] if i >= 0 else 0
+    def __setitem__(self, sha, value):
+        if not sha in self.added and self.find(sha) >= 0:
+            self.shadowed += 1
+        self.added[sha] = value
+        self.added_flags.pop(sha, None)
+    def __len__(self):
+        return self.count + len(self.added) - self.shadowed
+    def __iter__(self):
+        for sha, _ in self.items():
+            yield sha
+    def items(self):
+        for sha, offset, _, length in iter_unpack("<20s Q L L", self.records):
+            if not sha in self.added:
+                yield sha, (offset, length)
+        yield from self.added.items()
+    def sorted_records(self):
+        # every record, added ones merged in, in sha order
+        parts, start = [], 0
+        for sha in sorted(self.added):
+            i = self.position(sha)
+            parts.append(self.records[start * 36:i * 36])
+            offset, length = self.added[sha]
+            parts.append(pack("<20s Q L L", sha, offset, self.added_flags.get(sha, 0), length))
+            start = i + 1 if i < self.count and self.records[i * 36:i * 36 + 20] == sha else i
+        parts.append(self.records[start * 36:])
+        return b"".join(parts)
 
 class Chunkstore():
     def __init__(self, filename, depot=None, is_encrypted=None):
         filename = filename.replace(".csd","").replace(".csm","")
         self.csmname = filename + ".csm"
         self.csdname = filename + ".csd"
-        self.chunks = {}
+        self.csjname = filename + ".csj" # journal of chunks appended since the CSM was last written
+        self.chunks = ChunkIndex()
+        self.pending = [] # chunks that are in the journal but not yet in the CSM
+        self.indexed = 0 # number of records in the CSM on disk
+        self.csdfile, self.journal = None, None
+        self.reader, self.csdmap = None, None # kept open for get_chunk/get_chunks
+        if path.exists(filename + ".compact.csm"):
+            self.finish_compaction()
         if path.exists(self.csdname) and path.exists(self.csmname):
             with open(self.csmname, "rb") as csmfile:
                 self.csm = csmfile.read()
@@ -31,14 +191,102 @@ class Chunkstore():
         return f"Depot {self.depot} (encrypted: {self.is_encrypted}, chunks: {len(self.chunks)}) from CSD file {self.csdname}"
     def unpack(self, unpacker=None):
         if unpacker: assert callable(unpacker)
-        self.chunks = {}
-        with open(self.csmname, "rb") as csmfile: csm=csmfile.read()[0x14:]
-        for sha, offset, _, length in iter_unpack("<20s Q L L", csm):
+        self.chunks = ChunkIndex()
+        self.pending = []
+        self.indexed = 0
+        if path.exists(self.csmname):
+            with open(self.csmname, "rb") as csmfile: csm=csmfile.read()[0x14:]
+            csm = csm[:len(csm) - len(csm) % 36] # ignore a torn record from an interrupted append
+            if unpacker:
+                for sha, offset, _, length in iter_unpack("<20s Q L L", csm):
+                    unpacker(self, sha, offset, length)
+            self.chunks = ChunkIndex(csm)
+            self.indexed = len(csm) // 36
+        self.replay_journal(unpacker)
+    def replay_journal(self, unpacker=None):
+        # recover chunks that were appended to the CSD after the CSM was last
+        # written, e.g. by a download that crashed before finishing
+        if not path.exists(self.csjname): return
+        csd_size = path.getsize(self.csdname) if path.exists(self.csdname) else 0
+        with open(self.csjname, "rb") as journal: records = journal.read()
+        records = records[:len(records) - len(records) % 36]
+        for sha, offset, _, length in iter_unpack("<20s Q L L", records):
+            if offset + length > csd_size: break # data never made it to disk
+            if sha in self.chunks: continue
             self.chunks[sha] = (offset, length)
+            self.pending.append(sha)
             if unpacker: unpacker(self, sha, offset, length)
+    def open_writer(self):
+        if not self.csdfile:
+            # not opened for appending: copy_file_range refuses O_APPEND files,
+            # and every write seeks to the end anyway
+            self.csdfile = open(self.csdname, "r+b" if path.exists(self.csdname) else "w+b")
+            self.journal = open(self.csjname, "ab")
+            self.unsynced, self.last_sync = 0, monotonic()
+    def append_chunk(self, sha, data, sync_records=256, sync_seconds=5):
+        self.open_writer()
+        offset = self.csdfile.seek(0, 2)
+        length = self.csdfile.write(data)
+        return self.add_record(sha, offset, length, sync_records, sync_seconds)
+    def append_file(self, sha, filename, sync_records=256, sync_seconds=5):
+        # like append_chunk, but the chunk is copied straight from a loose
+        # chunk file without passing through python where the OS allows it
+        self.open_writer()
+        offset = self.csdfile.seek(0, 2)
+        self.csdfile.flush()
+        with open(filename, "rb") as f:
+            length = copy_range(f.fileno(), self.csdfile.fileno(), 0, offset, fstat(f.fileno()).st_size)
+        self.csdfile.seek(offset + length)
+        return self.add_record(sha, offset, length, sync_records, sync_seconds)
+    def add_record(self, sha, offset, length, sync_records, sync_seconds):
+        self.chunks[sha] = (offset, length)
+        self.pending.append(sha)
+        self.journal.write(pack("<20s Q L L", sha, offset, 0, length))
+        self.unsynced += 1
+        if self.unsynced >= sync_records or monotonic() - self.last_sync >= sync_seconds:
+            self.sync()
+        return offset, length
+    def sync(self):
+        # the chunk data has to be on disk before the journal records pointing to it
+        for f in (self.csdfile, self.journal):
+            f.flush()
+            fsync(f.fileno())
+        self.unsynced, self.last_sync = 0, monotonic()
+    def close(self):
+        self.close_reader()
+        if self.csdfile:
+            self.sync()
+            self.csdfile.close()
+            self.journal.close()
+            self.csdfile, self.journal = None, None
+        self.write_csm()
     def write_csm(self):
+        if self.journal:
+            self.sync()
+        if (self.indexed and path.exists(self.csmname) and len(self.chunks) == self.indexed + len(self.pending)
+                and len(self.chunks.added) * ChunkIndex.UNSORTED_SHARE <= len(self.chunks)):
+            # the CSM already holds everything but the pending chunks: append
+            # those and bump the chunk count in the header, as long as the
+            # unsorted tail this leaves stays short enough to load quickly
+            with open(self.csmname, "r+b") as csmfile:
+                csmfile.seek(0x14 + self.indexed * 36)
+                for sha in self.pending:
+                    offset, length = self.chunks[sha]
+                    csmfile.write(pack("<20s Q L L", sha, offset, 0, length))
+                csmfile.truncate()
+                csmfile.flush()
+                fsync(csmfile.fileno())
+                csmfile.seek(0x10)
+                csmfile.write(pack("<L", len(self.chunks)))
+        else:
+            self.rewrite_csm()
+        self.indexed = len(self.chunks)
+        self.pending = []
+        if not self.journal and path.exists(self.csjname):
+            remove(self.csjname)
+    def rewrite_csm(self):
         # write CSM header
-        with open(self.csmname, "wb") as csmfile:
+        with open(self.csmname + ".tmp", "wb") as csmfile:
             csmfile.write(b"SCFS\x14\x00\x00\x00")
             if self.is_encrypted:
                 csmfile.write(b"\x03\x00\x00\x00")
@@ -46,14 +294,152 @@ class Chunkstore():
                 csmfile.write(b"\x02\x00\x00\x00")
             csmfile.write(pack("<L L", self.depot, len(self.chunks)))
             csmfile.seek(0, 2) # make sure we're at the end of the csm file (in case we're writing to an existing csm)
-            # iterate over chunks
-            for sha, (offset, length) in self.chunks.items():
-                csmfile.write(sha)
-                csmfile.write(pack("<Q L L", offset, 0, length))
+            # records sorted by sha, so loading the CSM again doesn't have to sort them
+            records = self.chunks.sorted_records()
+            csmfile.write(records)
+            csmfile.flush()
+            fsync(csmfile.fileno())
+        replace(self.csmname + ".tmp", self.csmname)
+        self.chunks = ChunkIndex(records)
+    def size(self):
+        if self.csdfile:
+            return self.csdfile.seek(0, 2)
+        return path.getsize(self.csdname) if path.exists(self.csdname) else 0
+    def open_reader(self, end=0):
+        # (re)map the CSD if it isn't mapped yet or has grown past what we mapped
+        if self.csdmap is not None and end <= len(self.csdmap):
+            return
+        if self.csdfile:
+            self.csdfile.flush()
+        self.close_reader()
+        self.reader = open(self.csdname, "rb")
+        if path.getsize(self.csdname): # can't map an empty file
+            self.csdmap = mmap(self.reader.fileno(), 0, access=ACCESS_READ)
+    def close_reader(self):
+        if self.csdmap is not None:
+            try:
+                self.csdmap.close()
+            except BufferError:
+                pass # chunks returned by get_chunk are still in use; leave it to the garbage collector
+        if self.reader:
+            self.reader.close()
+        self.reader, self.csdmap = None, None
+    def compact(self, order):
+        # copy the chunks listed in order (shas, duplicates and chunks that
+        # aren't in this store are skipped) to a new CSD in that order, then
+        # swap it in for the old one; returns the number of bytes reclaimed
+        old_size = self.size()
+        new = Chunkstore(self.csdname[:-4] + ".compact", self.depot, self.is_encrypted)
+        for name in (new.csdname, new.csmname, new.csjname):
+            if path.exists(name): remove(name) # left over from an interrupted compaction
+        for sha in order:
+            if sha in self.chunks and not sha in new.chunks:
+                new.append_chunk(sha, self.get_chunk(sha))
+        if not new.csdfile:
+            open(new.csdname, "wb").close() # nothing left to keep
+        new.close() # once the new CSM exists, the compaction is committed
+        self.close_reader()
+        self.finish_compaction()
+        self.unpack()
+        return old_size - self.size()
+    def finish_compaction(self):
+        # swap in the files written by compact(); also run when opening a store
+        # whose compaction was interrupted after the new CSM was written
+        compacted = self.csdname[:-4] + ".compact"
+        if path.exists(self.csjname): remove(self.csjname) # offsets in the old CSD
+        if path.exists(compacted + ".csd"): replace(compacted + ".csd", self.csdname)
+        replace(compacted + ".csm", self.csmname)
     def get_chunk(self, sha):
-        with open(self.csdname, "rb") as csdfile:
-            csdfile.seek(self.chunks[sha][0])
-            return csdfile.read(self.chunks[sha][1])
+        # returns a memoryview into the mapped CSD, valid until the chunkstore is closed
+        offset, length = self.chunks[sha]
+        self.open_reader(offset + length)
+        return memoryview(self.csdmap)[offset:offset + length]
+    def get_chunks(self, shas, max_gap=64 * 1024, max_read=16 * 1024 * 1024):
+        # yields (sha, data) for many chunks in CSD order: chunks that are
+        # close together are fetched with a single read, and data is a
+        # memoryview into that read's buffer
+        requests = sorted((self.chunks[sha][0], self.chunks[sha][1], sha) for sha in shas)
+        if not requests: return
+        self.open_reader()
+        i = 0
+        while i < len(requests):
+            start, end = requests[i][0], requests[i][0] + requests[i][1]
+            j = i + 1
+            while j < len(requests) and requests[j][0] - end <= max_gap and requests[j][0] + requests[j][1] - start <= max_read:
+                end = max(end, requests[j][0] + requests[j][1])
+                j += 1
+            self.reader.seek(start)
+            span = memoryview(self.reader.read(end - start))
+            for offset, length, sha in requests[i:j]:
+                yield sha, span[offset - start:offset - start + length]
+            i = j
+
+class ChunkstoreVolumes():
+    # all of a depot's chunkstores (<depot>_depotcache_1, _2, ...), which may
+    # be spread over several directories; new chunks go to the last volume
+    # until it would grow past max_size, then the next volume is started in
+    # the next directory
+    def __init__(self, depot, is_encrypted, destdirs=["."], max_size=None):
+        self.depot = depot
+        self.is_encrypted = is_encrypted
+        self.destdirs = destdirs
+        self.max_size = max_size
+        self.volumes = {} # volume number -> Chunkstore
+        for destdir in destdirs:
+            # a volume whose first run crashed has a CSD and journal but no CSM yet
+            for name in glob(destdir + "/%s_depotcache_*.cs[dm]" % depot):
+                number = name[:-4].rsplit("_", 1)[1]
+                if not number.isdigit() or int(number) in self.volumes: continue
+                if is_encrypted == None and not path.exists(name[:-4] + ".csm"):
+                    print("skipping chunkstore without a CSM: " + name[:-4] + ".csd")
+                    continue
+                self.volumes[int(number)] = Chunkstore(name, depot, is_encrypted)
+    def __repr__(self):
+        return "\n".join(str(volume) for _, volume in sorted(self.volumes.items()))
+    def __contains__(self, sha):
+        return any(sha in volume.chunks for volume in self.volumes.values())
+    def find(self, sha):
+        # the volume a chunk is in, or None
+        for volume in self.volumes.values():
+            if sha in volume.chunks:
+                return volume
+        return None
+    def volume(self, number):
+        if not number in self.volumes:
+            destdir = self.destdirs[(number - 1) % len(self.destdirs)]
+            self.volumes[number] = Chunkstore(destdir + "/%s_depotcache_%s" % (self.depot, number), self.depot, self.is_encrypted)
+        return self.volumes[number]
+    def unpack(self):
+        for volume in self.volumes.values():
+            if path.exists(volume.csdname): volume.unpack()
+    def append_chunk(self, sha, data):
+        number = max(self.volumes, default=1)
+        volume = self.volume(number)
+        if self.max_size and volume.size() and volume.size() + len(data) > self.max_size:
+            volume.close()
+            volume = self.volume(number + 1)
+        return volume.append_chunk(sha, data)
+    def plan(self, chunks):
+        # split (sha, length) pairs between volumes ahead of time, so the
+        # volumes can be written in parallel; returns {volume number: [sha, ...]}
+        number = max(self.volumes, default=1)
+        size = self.volume(number).size()
+        plan = {}
+        for sha, length in chunks:
+            if self.max_size and size and size + length > self.max_size:
+                number += 1
+                size = 0
+            plan.setdefault(number, []).append(sha)
+            size += length
+        for number in plan: self.volume(number)
+        return plan
+    def sizes(self):
+        return {number: volume.size() for number, volume in sorted(self.volumes.items())}
+    def close(self):
+        # only volumes that were written to; the others may not even be unpacked
+        for volume in self.volumes.values():
+            if volume.csdfile or volume.pending:
+                volume.close()
 
 if __name__ == "__main__":
     if len(argv) > 1:
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from glob import glob
+from os.path import basename, exists
+from sys import stderr
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='Remove chunks that no retained manifest uses anymore from the backup files (.csd/.csm) of a depot.')
+    parser.add_argument("depotid", type=int, help="Depot whose chunkstores should be compacted")
+    parser.add_argument("-m", type=int, help="Manifest to keep the chunks of (can be used multiple times); if omitted, every manifest in depots/<depotid>/ is kept", action="append", metavar="manifestid", dest="manifests")
+    parser.add_argument("--destdir", help="Directory the chunkstores are in (can be used multiple times)", action="append")
+    parser.add_argument("-d", help="Dry run: only report how much space would be reclaimed", dest="dry_run", action="store_true")
+    args = parser.parse_args()
+
+from steam.core.manifest import DepotManifest
+from chunkstore import ChunkstoreVolumes, manifest_chunk_order
+
+if __name__ == "__main__":
+    manifest_paths = ["./depots/%s/%s.zip" % (args.depotid, manifest) for manifest in args.manifests or []]
+    if not args.manifests:
+        manifest_paths = sorted(glob("./depots/%s/*.zip" % args.depotid))
+    if not manifest_paths:
+        # without any manifests every chunk would look unused
+        print("no manifests to keep for depot %s, refusing to remove every chunk" % args.depotid, file=stderr)
+        exit(1)
+    # live chunks in the order the manifests' files use them, so files end up
+    # mostly contiguous in the compacted CSD
+    order = []
+    for manifest_path in manifest_paths:
+        if not exists(manifest_path):
+            print("manifest %s not found" % manifest_path, file=stderr)
+            exit(1)
+        with open(manifest_path, "rb") as f:
+            manifest = DepotManifest(f.read())
+        print("keeping chunks of manifest", basename(manifest_path).replace(".zip", ""))
+        order.extend(manifest_chunk_order(manifest))
+    live = set(order)
+
+    volumes = ChunkstoreVolumes(args.depotid, None, args.destdir or ["."])
+    if not volumes.volumes:
+        print("no chunkstores found for depot", args.depotid, file=stderr)
+        exit(1)
+    volumes.unpack()
+    total = 0
+    for number, volume in sorted(volumes.volumes.items()):
+        dead = [sha for sha in volume.chunks if not sha in live]
+        dead_bytes = sum(volume.chunks[sha][1] for sha in dead)
+        if args.dry_run or not dead:
+            print("chunkstore %s: %s of %s chunks unused (%s bytes)" % (volume.csdname, len(dead), len(volume.chunks), dead_bytes))
+            total += dead_bytes
+            continue
+        reclaimed = volume.compact(order)
+        print("chunkstore %s: removed %s of %s chunks, reclaimed %s bytes" % (volume.csdname, len(dead), len(dead) + len(volume.chunks), reclaimed))
+        total += reclaimed
+    print("%s %s bytes in total" % ("could reclaim" if args.dry_run else "reclaimed", total))
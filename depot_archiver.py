@@ -1,21 +1,37 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from asyncio import run, gather, sleep
+from asyncio import new_event_loop, ensure_future, gather, get_running_loop, sleep, Lock, Queue, QueueEmpty, Semaphore
 from binascii import hexlify
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from math import ceil
-from os import makedirs, path, listdir, remove
+from time import monotonic
+from os import makedirs, path, listdir, remove, replace
 from sys import argv
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
-    parser = ArgumentParser(description='Download Steam content depots for archival. Downloading apps: Specify an app to download all the depots for that app, or an app and depot ID to download the latest version of that depot (or a specific version if the manifest ID is specified.) Downloading workshop items: Use the -w flag to specify the ID of the workshop file to download. Exit code is 0 if all downloads succeeded, or the number of failures if at least one failed.')
+    parser = ArgumentParser(description='Download Steam content depots for archival. Downloading apps: Specify an app to download all the depots for that app, or an app and depot ID to download the latest version of that depot (or a specific version if the manifest ID is specified.) Downloading workshop items: Use the -w flag to specify the IDs of the workshop files to download (or -W to read them from a file). Exit code is 0 if all downloads succeeded, or the number of failures if at least one failed.')
     dl_group = parser.add_mutually_exclusive_group()
     dl_group.add_argument("-a", type=int, dest="downloads", metavar=("appid","depotid"), action="append", nargs='+', help="App, depot, and manifest ID to download. If the manifest ID is omitted, the lastest manifest specified by the public branch will be downloaded.\nIf the depot ID is omitted, all depots specified by the public branch will be downloaded.")
-    dl_group.add_argument("-w", type=int, nargs='?', help="Workshop file ID to download.", dest="workshop_id")
+    dl_group.add_argument("-w", type=int, nargs='+', help="Workshop file ID(s) to download.", dest="workshop_ids")
+    dl_group.add_argument("-W", type=str, help="File listing workshop file IDs to download, one per line.", dest="workshop_file")
+    dl_group.add_argument("-q", type=str, help="Batch mode: archive the pending targets in this queue database (created if missing), recording the result of each one. Interrupted runs resume where they left off.", dest="queue")
+    parser.add_argument("--enqueue", type=str, help="With -q: add the targets in this file (one 'appid [depotid [manifestid]]' per line) to the queue first; can be used multiple times", dest="enqueue", action="append")
+    parser.add_argument("--retry-failed", help="With -q: retry targets that failed in an earlier run", dest="retry_failed", action="store_true")
+    parser.add_argument("--batch-size", type=int, help="With -q: number of queued targets to archive concurrently, default 50", dest="batch_size", default=50)
+    parser.add_argument("--daemon", help="With -q: keep running and poll the queue for new targets", dest="daemon", action="store_true")
+    parser.add_argument("--poll-interval", type=int, help="With --daemon: seconds to wait between polls of an empty queue, default 60", dest="poll_interval", default=60)
     parser.add_argument("-b", help="Download into a Steam backup file instead of storing the chunks individually", dest="backup", action="store_true")
+    parser.add_argument("--packs", help="Store chunks in pack files (depots/<depotid>/packs/) instead of one file per chunk", dest="packs", action="store_true")
+    parser.add_argument("--volume-size", type=int, help="With -b: start a new backup file (_2, _3, ...) when one would grow past this many MB", dest="volume_size", nargs="?")
+    parser.add_argument("-v", help="Verify chunks as they are downloaded (decrypt, decompress and check sha1 in a process pool) and download failures again; needs the depot key in depot_keys.txt or keys/", dest="verify", action="store_true")
     parser.add_argument("-d", help="Dry run: download manifest (file metadata) without actually downloading files", dest="dry_run", action="store_true")
     parser.add_argument("-l", help="Use latest local appinfo instead of trying to download", dest="local_appinfo", action="store_true")
-    parser.add_argument("-c", type=int, help="Number of concurrent downloads to perform at once, default 10", dest="connection_limit", default=10)
+    parser.add_argument("-c", type=int, help="Number of concurrent downloads to start with, default 10 (raised while throughput keeps improving, lowered on errors)", dest="connection_limit", default=10)
+    parser.add_argument("-C", type=int, help="Maximum number of concurrent downloads, default 32", dest="max_connections", default=32)
+    parser.add_argument("-r", type=float, help="Limit total download speed to this many MB/s", dest="max_speed", nargs="?")
+    parser.add_argument("--parallel-depots", type=int, help="Number of depots to archive at once, default 10 (they share the -c/-C connections)", dest="parallel_depots", default=10)
+    parser.add_argument("--stripe", type=int, help="Number of fastest CDN servers to spread downloads across, default 4 (server scores are kept in cdn_scores.json between runs)", dest="stripe", default=4)
     parser.add_argument("-s", type=str, help="Specify a specific server URL instead of automatically selecting one, e.g. https://steampipe.akamaized.net", nargs='?', dest="server")
     parser.add_argument("-i", help="Log into a Steam account interactively.", dest="interactive", action="store_true")
     parser.add_argument("-u", type=str, help="Username for non-interactive login", dest="username", nargs="?")
@@ -25,12 +41,29 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
         print("connection limit must be at least 1")
         parser.print_help()
         exit(1)
-    if not args.downloads and not args.workshop_id:
-        print("must specify at least one appid or workshop file id")
+    if args.max_connections < args.connection_limit:
+        args.max_connections = args.connection_limit
+    if args.max_speed is not None and args.max_speed <= 0:
+        print("speed limit must be greater than 0")
         parser.print_help()
         exit(1)
-    if args.downloads and args.workshop_id:
-        print("must specify only app or workshop item, not both")
+    if args.batch_size < 1:
+        print("batch size must be at least 1")
+        parser.print_help()
+        exit(1)
+    if args.parallel_depots < 1:
+        print("number of parallel depots must be at least 1")
+        parser.print_help()
+        exit(1)
+    if args.stripe < 1:
+        print("stripe must be at least 1")
+        parser.print_help()
+        exit(1)
+    if args.workshop_file:
+        with open(args.workshop_file, "r") as f:
+            args.workshop_ids = [int(line.split("#")[0]) for line in f if line.split("#")[0].strip()]
+    if not args.downloads and not args.workshop_ids and not args.queue:
+        print("must specify at least one appid, workshop file id or queue")
         parser.print_help()
         exit(1)
 
@@ -41,12 +74,35 @@ from steam.enums import EResult
 from steam.enums.emsg import EMsg
 from steam.exceptions import SteamError
 from steam.protobufs.content_manifest_pb2 import ContentManifestPayload
+from gevent.pool import Pool as GeventPool
 from vdf import loads
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from login import auto_login
-from chunkstore import Chunkstore
+from chunkstore import ChunkstoreVolumes
+from packstore import Packstore
+from cdn_scores import ServerScoreboard
+from throttle import AdaptiveLimiter, RateLimiter, backoff_delay
+from chunkcodec import find_depot_key, verify_chunk
+from archive_queue import ArchiveQueue
 
-def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override=None, backup=False):
+async def open_session(connection_limit):
+    # one pooled session for the whole run, so keep-alive connections, TLS
+    # sessions and DNS lookups are shared by every worker and every depot
+    connector = TCPConnector(limit=connection_limit, limit_per_host=connection_limit, ttl_dns_cache=600, keepalive_timeout=60)
+    # stalled connections count as errors instead of hanging a worker forever
+    return ClientSession(connector=connector, timeout=ClientTimeout(sock_connect=15, sock_read=60))
+
+class DownloadState():
+    def __init__(self, chunks_total=0):
+        self.chunks_total = chunks_total
+        self.chunks_dled = 0
+        self.chunks_skipped = 0
+        self.chunks_failed = 0
+        self.bytes = 0
+    def chunks_done(self):
+        return self.chunks_dled + self.chunks_skipped + self.chunks_failed
+
+async def archive_manifest(manifest, c, session, budget, ratelimit, scoreboard, download_state, name="unknown", dry_run=False, server_override=None, backup=False, verify_pool=None, volume_size=None, packstore=None):
     if not manifest:
         return False
     print("Archiving", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
@@ -55,214 +111,400 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
     if dry_run:
         print("Not downloading chunks (dry run)")
         return True
+    chunkstore, journal = None, None
     if backup:
-        chunkstore = Chunkstore(str(manifest.depot_id) + "_depotcache_1.csm", depot=manifest.depot_id, is_encrypted=True)
-        if path.exists(chunkstore.csdname): chunkstore.unpack()
-        csdfile = open(chunkstore.csdname, "ab")
-    else:
-        chunkstore, csdfile = None, None
-    known_chunks = []
+        chunkstore = ChunkstoreVolumes(manifest.depot_id, True, max_size=volume_size)
+        chunkstore.unpack() # also replays the journal of an interrupted run
+    elif not packstore:
+        # chunks finished by earlier (possibly interrupted) runs of this or
+        # another manifest of the depot; depot_validator takes bad ones out
+        journal_path = dest + "%s.journal" % manifest.gid
+        journaled_chunks = set()
+        for other_journal in glob(dest + "*.journal"):
+            with open(other_journal, "r") as f:
+                journaled_chunks.update(line for line in f.read().split("\n") if len(line) == 40)
+        journal = open(journal_path, "a")
+    # dedupe chunks and hand them out largest-first from a shared queue, so
+    # no single worker ends up with a long tail of big chunks to itself
+    known_chunks = {}
     for file in manifest.payload.mappings:
         for chunk in file.chunks:
-            known_chunks.append(chunk.sha)
+            known_chunks[chunk.sha] = chunk.cb_compressed
+    chunk_queue = Queue()
+    for chunk in sorted(known_chunks, key=known_chunks.get, reverse=True):
+        chunk_queue.put_nowait(chunk)
+    download_state.chunks_total = len(known_chunks)
     print("Beginning to download", len(known_chunks), "encrypted", "chunk" if len(known_chunks) == 1 else "chunks")
-    class download_state():
-        def __init__(self):
-            self.chunks_dled = 0
-            self.chunks_skipped = 0
-            self.bytes = 0
-    download_state = download_state()
-    async def dl_worker(chunks, download_state, servers, chunkstore=None, csdfile=None):
-        server = servers[0]
-        async with ClientSession() as session:
-            for index, chunk in enumerate(chunks):
-                if path.exists(dest + hexlify(chunk).decode()) or (chunkstore and (chunk in chunkstore.chunks.keys())):
+    servers = [server_override] if server_override else list(c.servers)
+    max_attempts = 20
+    depotkey = None
+    if verify_pool:
+        depotkey = find_depot_key(manifest.depot_id)
+        if not depotkey:
+            print("\033[31mwarning: no key for depot %s, chunks will not be verified\033[0m" % manifest.depot_id)
+    verify_failures = {}
+    async def dl_worker(chunk_queue, download_state, chunkstore=None):
+        while True:
+            try:
+                chunk = chunk_queue.get_nowait()
+            except QueueEmpty:
+                return
+            chunk_str = hexlify(chunk).decode()
+            if chunkstore:
+                if chunk in chunkstore:
                     download_state.chunks_skipped += 1
-                    del chunks[index]
-            for chunk in chunks:
-                chunk_str = hexlify(chunk).decode()
-                if path.exists(dest + chunk_str) or (chunkstore and (chunk in chunkstore.chunks.keys())):
+                    continue
+            elif packstore:
+                if chunk in packstore:
                     download_state.chunks_skipped += 1
                     continue
-                if not csdfile: f = open(dest + chunk_str, "wb")
-                else: f = csdfile
-                while True:
-                    try:
-                        if server_override:
-                            request_url = "%s/depot/%s/chunk/%s" % (server_override, manifest.depot_id, chunk_str)
-                            host = server_override
-                        else:
-                            request_url = "%s://%s:%s/depot/%s/chunk/%s" % ("https" if server.https else "http",
-                                server.host,
-                                server.port,
-                                manifest.depot_id,
-                                chunk_str)
-                            host = ("https" if server.https else "http") + "://" + server.host
+            elif chunk_str in journaled_chunks:
+                download_state.chunks_skipped += 1
+                continue
+            elif depotkey and path.exists(dest + chunk_str):
+                # chunk from a run that predates the journal: only trusted once
+                # it checks out, anything else is downloaded again
+                with open(dest + chunk_str, "rb") as f:
+                    content = f.read()
+                if await get_running_loop().run_in_executor(verify_pool, verify_chunk, content, chunk, depotkey):
+                    journal.write(chunk_str + "\n")
+                    download_state.chunks_skipped += 1
+                    continue
+            content = None
+            for attempt in range(max_attempts):
+                host = scoreboard.host(scoreboard.pick(servers))
+                request_url = "%s/depot/%s/chunk/%s" % (host, manifest.depot_id, chunk_str)
+                retry_after = None
+                try:
+                    # the budget is shared by every depot in the run
+                    async with budget:
+                        start = monotonic()
                         async with session.get(request_url) as response:
+                            latency = monotonic() - start
                             if response.ok:
-                                download_state.bytes += response.content_length
                                 content = await response.content.read()
+                                download_state.bytes += len(content)
+                                scoreboard.record(host, latency, len(content), monotonic() - start)
+                                budget.record(len(content))
                                 break
+                            elif response.status == 429:
+                                retry_after = response.headers.get("Retry-After")
+                                print(f"server {host} is rate limiting us, backing off")
                             elif 400 <= response.status < 500:
-                                print(f"\033[31merror: received status code {response.status} (on chunk {chunk_str}, server {host})\003[0m")
-                                return False
-                    except Exception as e:
-                        print("rotating to next server:", e)
-                    servers.rotate(-1)
-                    server = servers[0]
-                    await sleep(0.5)
-                f.seek(0, 2)
-                offset = f.tell()
-                length = f.write(content)
-                if chunkstore:
-                    chunkstore.chunks[chunk] = (offset, length)
-                if not csdfile: f.close()
-                download_state.chunks_dled += 1
-    async def summary_printer(download_state):
-        averages = []
-        last_msg_length = 0
-        while download_state.chunks_dled + download_state.chunks_skipped != len(known_chunks):
-            averages.append(download_state.bytes)
-            download_state.bytes = 0
-            if len(averages) == 6:
-                del averages[0]
-            speed = 0
-            for average in averages:
-                speed += average
-            speed = round(speed / len(averages) / 1000000, 2)
-            msg = f"\rDownloading at {speed}MB/s ({download_state.chunks_dled + download_state.chunks_skipped}/{len(known_chunks)})"
-            if last_msg_length > len(msg):
-                whitespace = " " * (last_msg_length - len(msg))
+                                print(f"\033[31merror: received status code {response.status} (on chunk {chunk_str}, server {host})\033[0m")
+                                break
+                except Exception as e:
+                    print("rotating to next server:", e)
+                budget.backoff()
+                scoreboard.record_failure(host)
+                await sleep(backoff_delay(attempt, retry_after))
+            if content is None:
+                download_state.chunks_failed += 1
+                continue
+            if ratelimit:
+                await ratelimit.consume(len(content))
+            if depotkey and not await get_running_loop().run_in_executor(verify_pool, verify_chunk, content, chunk, depotkey):
+                verify_failures[chunk] = verify_failures.get(chunk, 0) + 1
+                if verify_failures[chunk] >= 3:
+                    print(f"\033[31merror: chunk {chunk_str} failed verification {verify_failures[chunk]} times\033[0m")
+                    download_state.chunks_failed += 1
+                else:
+                    print(f"chunk {chunk_str} failed verification, downloading it again")
+                    chunk_queue.put_nowait(chunk)
+                continue
+            if chunkstore:
+                chunkstore.append_chunk(chunk, content)
+            elif packstore:
+                packstore.add_chunk(chunk, content)
             else:
-                whitespace = ""
-            print(msg + whitespace,end="")
-            last_msg_length = len(msg)
-            await sleep(1)
+                # write under a temporary name so an interrupted run never
+                # leaves a truncated chunk behind under its real name
+                with open(dest + chunk_str + ".part", "wb") as f:
+                    f.write(content)
+                replace(dest + chunk_str + ".part", dest + chunk_str)
+                journal.write(chunk_str + "\n")
+                journal.flush()
+            download_state.chunks_dled += 1
 
-    async def run_workers(download_state):
-        workers = [summary_printer(download_state)]
-        chunk_size = int(ceil(len(known_chunks)/args.connection_limit))
-        for i in range(args.connection_limit):
-            workers.append(dl_worker(known_chunks[i * chunk_size:i * chunk_size + chunk_size], download_state, c.servers.copy(), chunkstore, csdfile))
+    workers = []
+    for i in range(min(budget.maximum, len(known_chunks))):
+        workers.append(ensure_future(dl_worker(chunk_queue, download_state, chunkstore)))
+    try:
         await gather(*workers)
-
-    run(run_workers(download_state))
-    if chunkstore:
-        chunkstore.write_csm()
-        csdfile.close()
+    finally:
+        # if one worker failed, the others must be stopped before the
+        # chunkstore or journal is closed (and the next manifest of the depot
+        # opens them again)
+        for worker in workers:
+            worker.cancel()
+        await gather(*workers, return_exceptions=True)
+        if chunkstore:
+            chunkstore.close()
+        elif packstore:
+            packstore.sync() # the pack itself is finished once the whole run is
+        else:
+            journal.close()
     print("\nFinished downloading", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
     print("Downloaded %s %s and skipped %s" % (download_state.chunks_dled, "chunk" if download_state.chunks_dled == 1 else "chunks", download_state.chunks_skipped))
+    if download_state.chunks_failed:
+        print("\033[31m%s %s failed to download\033[0m" % (download_state.chunks_failed, "chunk" if download_state.chunks_failed == 1 else "chunks"))
+        return False
     return True
 
-def try_load_manifest(appid, depotid, manifestid):
+async def summary_printer(download_states, budget):
+    averages = []
+    last_msg_length = 0
+    while True:
+        averages.append(0)
+        for download_state in download_states:
+            averages[-1] += download_state.bytes
+            download_state.bytes = 0
+        if len(averages) == 6:
+            del averages[0]
+        speed = 0
+        for average in averages:
+            speed += average
+        speed = round(speed / len(averages) / 1000000, 2)
+        chunks_done = sum(download_state.chunks_done() for download_state in download_states)
+        chunks_total = sum(download_state.chunks_total for download_state in download_states)
+        msg = f"\rDownloading at {speed}MB/s ({chunks_done}/{chunks_total}, {budget})"
+        if last_msg_length > len(msg):
+            whitespace = " " * (last_msg_length - len(msg))
+        else:
+            whitespace = ""
+        print(msg + whitespace,end="")
+        last_msg_length = len(msg)
+        await sleep(1)
+
+async def archive_targets(targets, c, session, scoreboard, verify_pool=None):
+    # every depot shares one connection budget; several depots are in flight
+    # at once so manifest fetches for the next depots overlap with chunk
+    # downloads for the current ones
+    budget = AdaptiveLimiter(args.connection_limit, args.max_connections)
+    ratelimit = RateLimiter(args.max_speed * 1000000) if args.max_speed else None
+    depot_slots = Semaphore(args.parallel_depots)
+    depot_locks = {}
+    packstores = {} # depot -> Packstore, shared by every manifest of the depot in this run
+    download_states = []
+    manifests = await prefetch_manifests(targets, session, scoreboard)
+    async def archive_target(appid, depotid, manifestid, name):
+        async with depot_slots:
+            try:
+                manifest = await manifests[(appid, depotid, manifestid)]
+            except Exception as e:
+                print("\033[31merror fetching depot %s manifest %s:\033[0m %s" % (depotid, manifestid, e))
+                return False
+            # two manifests of the same depot share a chunkstore in backup mode;
+            # loose chunks are written atomically and packs go through the shared
+            # packstore, so those can run side by side
+            async with depot_locks.setdefault(str(depotid) if args.backup else (depotid, manifestid), Lock()):
+                download_state = DownloadState()
+                download_states.append(download_state)
+                try:
+                    if args.packs and not depotid in packstores:
+                        packstores[depotid] = Packstore("./depots/%s/packs" % depotid)
+                    return await archive_manifest(manifest, c, session, budget, ratelimit, scoreboard, download_state, name, args.dry_run, args.server, args.backup, verify_pool, args.volume_size * 1024 * 1024 if args.volume_size else None, packstores.get(depotid))
+                except Exception as e:
+                    # one broken depot shouldn't take the rest of the run down with it
+                    print("\033[31merror archiving depot %s manifest %s:\033[0m %s" % (depotid, manifestid, e))
+                    return False
+    printer = ensure_future(summary_printer(download_states, budget))
+    try:
+        targets = list(dict.fromkeys(targets))
+        results = await gather(*[archive_target(*target) for target in targets])
+    finally:
+        printer.cancel()
+        scoreboard.save()
+        for packstore in packstores.values():
+            packstore.close()
+    return dict(zip(targets, results))
+
+async def cdn_get(session, scoreboard, servers, request_path, max_attempts=20):
+    for attempt in range(max_attempts):
+        host = scoreboard.host(scoreboard.pick(servers))
+        retry_after = None
+        try:
+            start = monotonic()
+            async with session.get("%s/%s" % (host, request_path)) as response:
+                latency = monotonic() - start
+                if response.ok:
+                    content = await response.read()
+                    scoreboard.record(host, latency, len(content), monotonic() - start)
+                    return content
+                elif response.status == 429:
+                    retry_after = response.headers.get("Retry-After")
+                elif 400 <= response.status < 500:
+                    print("Got status code", response.status, response.reason, "requesting", request_path)
+                    return None
+                else:
+                    print("Got status code", response.status, response.reason, "requesting", request_path, "from", host)
+        except Exception as e:
+            print("rotating to next server:", e)
+        scoreboard.record_failure(host)
+        await sleep(backoff_delay(attempt, retry_after))
+    return None
+
+def get_request_code(appid, depotid, manifestid):
+    license_requested = False
+    while True:
+        try:
+            request_code = c.get_manifest_request_code(appid, depotid, manifestid)
+            print("Obtained code", request_code, "for depot", depotid, "valid as of", datetime.now())
+            return request_code
+        except SteamError as e:
+            if e.eresult == EResult.AccessDenied:
+                if not license_requested:
+                    result, granted_appids, granted_packageids = steam_client.request_free_license([appid])
+                    license_requested = True
+                    continue
+                print(e.message)
+                print(f"Use the -i flag to log into a Steam account with access to this depot, or place a downloaded copy of the manifest at depots/{depotid}/{manifestid}.zip")
+                return False
+            else:
+                print(e.message + ": " + str(e.eresult))
+                return False
+
+def load_cached_manifest(appid, depotid, manifestid):
     print(f"Getting a manifest for app {appid} depot {depotid} gid {manifestid}")
     dest = "./depots/%s/%s.zip" % (depotid, manifestid)
     makedirs("./depots/%s" % depotid, exist_ok=True)
     if path.exists(dest):
         with open(dest, "rb") as f:
-            print("Loaded cached manifest %s from disk" % manifestid)
-            return CDNDepotManifest(c, appid, f.read())
-    else:
-        while True:
-            license_requested = False
-            try:
-                request_code = c.get_manifest_request_code(appid, depotid, manifestid)
-                print("Obtained code", request_code, "for depot", depotid, "valid as of", datetime.now())
-                resp = c.cdn_cmd('depot', '%s/manifest/%s/5/%s' % (depotid, manifestid, request_code))
-                if not resp.ok:
-                    print("Got status code", resp.status_code, resp.reason, "trying to download depot", depotid, "manifest", manifestid)
-                    return False
-                break
-            except SteamError as e:
-                if e.eresult == EResult.AccessDenied:
-                    if not license_requested:
-                        result, granted_appids, granted_packageids = steam_client.request_free_license([appid])
-                        license_requested = True
-                        continue
-                    print(e.message)
-                    print(f"Use the -i flag to log into a Steam account with access to this depot, or place a downloaded copy of the manifest at depots/{depotid}/{manifestid}.zip")
-                    return False
-                else:
-                    print(e.message + ": " + str(e.eresult))
-                    return False
-        print("Downloaded manifest %s" % manifestid)
-        print("Saving manifest...") # write manifest to disk. this will be a standard Zip with protobuf data inside
-        with open(dest, "wb") as f:
-            f.write(resp.content)
-        return CDNDepotManifest(c, appid, resp.content)
-
-def get_gid(manifest):
-    if type(manifest) == str:
-        return int(manifest)
-    elif type(manifest) == int:
+            content = f.read()
+        try:
+            manifest = CDNDepotManifest(c, appid, content)
+        except Exception as e:
+            # e.g. truncated by an interrupted download: set it aside and download it again
+            print("\033[31merror: cached manifest %s is damaged (%s), downloading it again\033[0m" % (dest, e))
+            replace(dest, dest + ".bad")
+            return None
+        print("Loaded cached manifest %s from disk" % manifestid)
         return manifest
-    else:
-        return manifest["gid"]
+    return None
 
-if __name__ == "__main__":
-    # Create directories
-    makedirs("./appinfo", exist_ok=True)
-    makedirs("./depots", exist_ok=True)
+async def download_manifest(appid, depotid, manifestid, request_code, session, scoreboard):
+    if request_code is False:
+        return False
+    content = await cdn_get(session, scoreboard, list(c.servers), 'depot/%s/manifest/%s/5/%s' % (depotid, manifestid, request_code))
+    if content is None:
+        print("Failed to download depot", depotid, "manifest", manifestid)
+        return False
+    print("Downloaded manifest %s" % manifestid)
+    print("Saving manifest...") # write manifest to disk. this will be a standard Zip with protobuf data inside
+    dest = "./depots/%s/%s.zip" % (depotid, manifestid)
+    with open(dest + ".part", "wb") as f:
+        f.write(content)
+    replace(dest + ".part", dest)
+    return CDNDepotManifest(c, appid, content)
 
-    steam_client = SteamClient()
-    print("Connecting to the Steam network...")
-    steam_client.connect()
-    print("Logging in...")
-    if args.interactive:
-        auto_login(steam_client, fallback_anonymous=False, relogin=False)
-    elif args.username:
-        auto_login(steam_client, args.username, args.password)
+async def prefetch_manifests(targets, session, scoreboard, manifest_limit=8):
+    # Cached manifests are loaded from disk. Request codes for the rest are
+    # resolved in parallel on the Steam connection (which runs on gevent), then
+    # the manifests are downloaded in the background with bounded parallelism.
+    # Returns a future per (appid, depotid, manifestid).
+    loop = get_running_loop()
+    manifests = {}
+    missing = []
+    for appid, depotid, manifestid, _ in targets:
+        if (appid, depotid, manifestid) in manifests: continue
+        manifest = load_cached_manifest(appid, depotid, manifestid)
+        if manifest:
+            manifests[(appid, depotid, manifestid)] = loop.create_future()
+            manifests[(appid, depotid, manifestid)].set_result(manifest)
+        else:
+            manifests[(appid, depotid, manifestid)] = None
+            missing.append((appid, depotid, manifestid))
+    if missing:
+        print("Requesting codes for", len(missing), "manifest" if len(missing) == 1 else "manifests")
+    request_codes = GeventPool(manifest_limit).map(lambda target: get_request_code(*target), missing)
+    slots = Semaphore(manifest_limit)
+    async def fetch(target, request_code):
+        async with slots:
+            return await download_manifest(*target, request_code, session, scoreboard)
+    for target, request_code in zip(missing, request_codes):
+        manifests[target] = ensure_future(fetch(target, request_code))
+    return manifests
+
+def local_appinfo_index():
+    # latest local changenumber for every app, from a single listing of ./appinfo
+    changenumbers = {}
+    for file in listdir("./appinfo/"):
+        if not file.endswith(".vdf"): continue
+        try:
+            appid, changenumber = (int(x) for x in file.replace(".vdf", "").split("_"))
+        except ValueError:
+            continue
+        if changenumber > changenumbers.get(appid, 0):
+            changenumbers[appid] = changenumber
+    return changenumbers
+
+def fetch_appinfo(appids, in_flight=4):
+    # one access token request for every app, then PICS requests in groups of
+    # 30 (the maximum number of apps PICS will give us in one message) with a
+    # few of them in flight at once
+    print("Fetching appinfo for", len(appids), "app" if len(appids) == 1 else "apps")
+    tokens = steam_client.get_access_tokens(app_ids=appids)
+    if not tokens or not 'apps' in tokens.keys():
+        tokens = {'apps': {}}
+    def fetch_group(group, max_attempts=5):
+        msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
+        for appid in group:
+            body_app = msg.body.apps.add()
+            body_app.appid = appid
+            if appid in tokens['apps'].keys():
+                body_app.access_token = tokens['apps'][appid]
+        for attempt in range(max_attempts):
+            job = steam_client.send_job(msg)
+            apps = []
+            while True:
+                response = steam_client.wait_event(job, 15)
+                if not response:
+                    print("Timeout reached waiting for appinfo, retrying...")
+                    break
+                apps.extend(response[0].body.apps)
+                if not response[0].body.response_pending:
+                    return apps
+        # the apps in this group end up unresolved
+        print("\033[31merror: no appinfo response after %s attempts for apps\033[0m" % max_attempts, ", ".join(str(appid) for appid in group))
+        return []
+    appinfo_responses = {}
+    groups = [appids[i:i + 30] for i in range(0, len(appids), 30)]
+    for apps in GeventPool(in_flight).imap_unordered(fetch_group, groups):
+        for appinfo_response in apps:
+            appinfo_responses[appinfo_response.appid] = appinfo_response
+    return appinfo_responses
+
+def resolve_downloads(downloads, local_appinfo=False):
+    # Turn -a style (appid[, depotid[, manifestid]]) tuples into the list of
+    # (appid, depotid, manifestid, name) targets to archive for each of them,
+    # or None if the tuple couldn't be resolved. Appinfo for every app is
+    # resolved at once.
+    appids = list(dict.fromkeys(dl_tuple[0] for dl_tuple in downloads))
+    if local_appinfo:
+        local_changenumbers = local_appinfo_index()
     else:
-        auto_login(steam_client)
-    c = CDNClient(steam_client)
-    if args.workshop_id:
-        response = steam_client.send_um_and_wait("PublishedFile.GetDetails#1", {'publishedfileids':[args.workshop_id]})
-        if response.header.eresult != EResult.OK:
-            print("\033[31merror: couldn't get workshop item info:\033[0m", response.header.error_message)
-            exit(1)
-        file = response.body.publishedfiledetails[0]
-        if file.result != EResult.OK:
-            print("\033[31merror: steam returned error\033[0m", EResult(file.result))
-            exit(1)
-        print("Retrieved data for workshop item", file.title, "for app", file.consumer_appid, "(%s)" % file.app_name)
-        if not file.hcontent_file:
-            print("\033[31merror: workshop item is not on SteamPipe\033[0m")
-            exit(1)
-        if file.file_url:
-            print("\033[31merror: workshop item is not on SteamPipe: its download URL is\033[0m", file.file_url)
-            exit(1)
-        archive_manifest(try_load_manifest(file.consumer_appid, file.consumer_appid, file.hcontent_file), c, file.title, args.dry_run, args.server, args.backup)
-        exit(0)
+        appinfo_responses = fetch_appinfo(appids)
 
-    # Iterate over all the downloads we want
-    exit_status = 0
-    for dl_tuple in args.downloads:
+    resolved = {}
+    for dl_tuple in downloads:
+        dl_tuple = tuple(dl_tuple)
+        resolved[dl_tuple] = None
+        targets = []
         appid = dl_tuple[0]
         depotid = (dl_tuple[1] if len(dl_tuple) > 1 else None)
         manifestid = (dl_tuple[2] if len(dl_tuple) > 2 else None)
 
         # Fetch appinfo
-        if args.local_appinfo:
-            highest_changenumber = 0
-            for file in listdir("./appinfo/"):
-                if not file.endswith(".vdf"): continue
-                if not file.startswith(str(appid) + "_"): continue
-                changenumber = int(file.split("_")[1].replace(".vdf", ""))
-                if changenumber > highest_changenumber:
-                    highest_changenumber = changenumber
-            if highest_changenumber == 0:
+        if local_appinfo:
+            if not appid in local_changenumbers:
                 print("\033[31merror: -l flag specified, but no local appinfo exists for app\033[0m", appid)
-                exit(1)
-            appinfo_path = "./appinfo/%s_%s.vdf" % (appid, highest_changenumber)
+                continue
+            appinfo_path = "./appinfo/%s_%s.vdf" % (appid, local_changenumbers[appid])
         else:
-            print("Fetching appinfo for", appid)
-            tokens = steam_client.get_access_tokens(app_ids=[appid])
-            msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
-            body_app = msg.body.apps.add()
-            body_app.appid = appid
-            if 'apps' in tokens.keys() and appid in tokens['apps'].keys():
-                body_app.access_token = tokens['apps'][appid]
-            appinfo_response = steam_client.wait_event(steam_client.send_job(msg))[0].body.apps[0]
+            if not appid in appinfo_responses:
+                print("\033[31merror: Steam returned no appinfo for app\033[0m", appid)
+                continue
+            appinfo_response = appinfo_responses[appid]
             changenumber = appinfo_response.change_number
             # Write vdf appinfo to disk
             appinfo_path = "./appinfo/%s_%s.vdf" % (appid, changenumber)
@@ -288,20 +530,134 @@ if __name__ == "__main__":
                     "info, run get_appinfo.py on this app using an account "
                     "authorized to access it.")
 
-        if depotid:
-            name = appinfo['depots'][str(depotid)]['name'] if 'name' in appinfo['depots'][str(depotid)] else 'unknown'
-            if manifestid:
-                print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifestid)
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifestid), c, name, args.dry_run, args.server, args.backup) else 1)
+        try:
+            if depotid:
+                name = appinfo['depots'][str(depotid)]['name'] if 'name' in appinfo['depots'][str(depotid)] else 'unknown'
+                if manifestid:
+                    print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifestid)
+                    targets.append((appid, depotid, manifestid, name))
+                else:
+                    manifest = get_gid(appinfo['depots'][str(depotid)]['manifests']['public'])
+                    print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifest)
+                    targets.append((appid, depotid, manifest, name))
             else:
-                manifest = get_gid(appinfo['depots'][str(depotid)]['manifests']['public'])
-                print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifest)
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifest), c, name, args.dry_run, args.server, args.backup) else 1)
+                print("Archiving all latest depots for", appinfo['common']['name'], "build", appinfo['depots']['branches']['public']['buildid'])
+                for depot in appinfo["depots"]:
+                    depotinfo = appinfo["depots"][depot]
+                    if not "manifests" in depotinfo or not "public" in depotinfo["manifests"]:
+                        continue
+                    targets.append((appid, int(depot), get_gid(depotinfo["manifests"]["public"]), depotinfo["name"] if "name" in depotinfo else "unknown"))
+        except KeyError as e:
+            print("\033[31merror: appinfo for app %s has no %s\033[0m" % (appid, e))
+            continue
+        resolved[dl_tuple] = targets
+    return resolved
+
+def fetch_workshop_details(workshop_ids, batch=100, in_flight=4):
+    # PublishedFile.GetDetails takes many items per request, so look up
+    # workshop items in batches with a few requests in flight at once
+    def fetch_batch(ids):
+        response = steam_client.send_um_and_wait("PublishedFile.GetDetails#1", {'publishedfileids': ids}, timeout=30)
+        if response is None:
+            print("\033[31merror: timed out getting workshop item info\033[0m")
+            return []
+        if response.header.eresult != EResult.OK:
+            print("\033[31merror: couldn't get workshop item info:\033[0m", response.header.error_message)
+            return []
+        return list(response.body.publishedfiledetails)
+    print("Fetching details for", len(workshop_ids), "workshop item" if len(workshop_ids) == 1 else "workshop items")
+    details = []
+    batches = [workshop_ids[i:i + batch] for i in range(0, len(workshop_ids), batch)]
+    for files in GeventPool(in_flight).imap_unordered(fetch_batch, batches):
+        details.extend(files)
+    return details
+
+def get_gid(manifest):
+    if type(manifest) == str:
+        return int(manifest)
+    elif type(manifest) == int:
+        return manifest
+    else:
+        return manifest["gid"]
+
+if __name__ == "__main__":
+    # Create directories
+    makedirs("./appinfo", exist_ok=True)
+    makedirs("./depots", exist_ok=True)
+
+    steam_client = SteamClient()
+    def log_in():
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False, relogin=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
         else:
-            print("Archiving all latest depots for", appinfo['common']['name'], "build", appinfo['depots']['branches']['public']['buildid'])
-            for depot in appinfo["depots"]:
-                depotinfo = appinfo["depots"][depot]
-                if not "manifests" in depotinfo or not "public" in depotinfo["manifests"]:
+            auto_login(steam_client)
+    log_in()
+    c = CDNClient(steam_client)
+    # a single event loop, HTTP session and scoreboard are reused for every depot
+    loop = new_event_loop()
+    session = loop.run_until_complete(open_session(args.max_connections))
+    scoreboard = ServerScoreboard(stripe=args.stripe)
+    verify_pool = ProcessPoolExecutor() if args.verify else None
+    def archive(targets):
+        return loop.run_until_complete(archive_targets(targets, c, session, scoreboard, verify_pool))
+    def finish(exit_status):
+        loop.run_until_complete(session.close())
+        if verify_pool: verify_pool.shutdown()
+        exit(exit_status)
+    if args.workshop_ids:
+        targets = []
+        for file in fetch_workshop_details(list(dict.fromkeys(args.workshop_ids))):
+            if file.result != EResult.OK:
+                print("\033[31merror: steam returned error for workshop item\033[0m", file.publishedfileid, EResult(file.result))
+            elif not file.hcontent_file:
+                print("\033[31merror: workshop item is not on SteamPipe:\033[0m", file.publishedfileid)
+            elif file.file_url:
+                print("\033[31merror: workshop item is not on SteamPipe:\033[0m", file.publishedfileid, "its download URL is", file.file_url)
+            else:
+                print("Retrieved data for workshop item", file.title, "for app", file.consumer_appid, "(%s)" % file.app_name)
+                targets.append((file.consumer_appid, file.consumer_appid, file.hcontent_file, file.title))
+        failures = len(set(args.workshop_ids)) - len(targets) # including items steam didn't return at all
+        finish(list(archive(targets).values()).count(False) + failures)
+
+    if args.queue:
+        # batch mode: work through the queue database with one logged-in client
+        queue = ArchiveQueue(args.queue)
+        for file in args.enqueue or []:
+            print("Added", queue.import_file(file), "targets from", file)
+        if args.retry_failed:
+            queue.retry_failed()
+        print(queue)
+        failures = 0
+        while True:
+            batch = queue.take(args.batch_size)
+            if not batch:
+                if not args.daemon:
+                    break
+                steam_client.sleep(args.poll_interval)
+                continue
+            if not steam_client.logged_on:
+                print("Lost connection to Steam, logging in again...")
+                steam_client.disconnect()
+                log_in()
+            resolved = resolve_downloads(batch, args.local_appinfo)
+            results = archive([target for dl_targets in resolved.values() if dl_targets for target in dl_targets])
+            for dl_tuple, dl_targets in resolved.items():
+                if dl_targets is None:
+                    queue.mark(dl_tuple, False, "couldn't resolve appinfo")
+                    failures += 1
                     continue
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depot, get_gid(depotinfo["manifests"]["public"])), c, depotinfo["name"] if "name" in depotinfo else "unknown", args.dry_run, args.server, args.backup) else 1)
-    exit(exit_status)
+                failed = [target for target in dl_targets if not results[target]]
+                queue.mark(dl_tuple, not failed, ", ".join("depot %s manifest %s failed" % target[1:3] for target in failed) or None)
+                failures += bool(failed)
+            print(queue)
+        finish(failures)
+
+    # Resolve appinfo for every app at once, then archive all the downloads together
+    resolved = resolve_downloads(args.downloads, args.local_appinfo)
+    targets = [target for dl_targets in resolved.values() if dl_targets for target in dl_targets]
+    finish(list(archive(targets).values()).count(False) + list(resolved.values()).count(None))
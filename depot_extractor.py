@@ -1,18 +1,18 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from binascii import hexlify
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
 from fnmatch import fnmatch
 from glob import glob
 from hashlib import sha1
-from io import BytesIO
-from os import makedirs, remove
-from os.path import dirname, exists
+from os import O_CREAT, O_WRONLY, close, cpu_count, fstat, ftruncate, makedirs, remove, replace, rmdir, open as os_open
+from os.path import dirname, exists, isfile
 from pathlib import Path
 from struct import unpack
 from sys import argv
-from zipfile import ZipFile
-import lzma
+import os
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
     parser = ArgumentParser(description='Extract downloaded depots.')
@@ -21,13 +21,51 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
     parser.add_argument('depotkey', type=str, nargs='?')
     parser.add_argument('-d', dest="dry_run", help="dry run: verify chunks without extracting", action="store_true")
     parser.add_argument('-f', dest="files", help="List files to extract (can be used multiple times); if ommitted, all files will be extracted. Glob matching supported.", action="append")
-    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder)", nargs='?')
+    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder); can be used multiple times for a backup spread over several directories", action="append")
     parser.add_argument('--dest', help="directory to place extracted files in", type=str, default="extract")
+    parser.add_argument('-u', dest="update_from", help="update an existing extraction in --dest from this older manifest: only added and modified files are extracted, unchanged chunks are copied from the old files, and removed files are deleted", type=int)
+    parser.add_argument('--repair', help="check the files already extracted in --dest against the manifest's checksums and re-extract only the chunks that are missing or damaged", action="store_true")
+    parser.add_argument('--cache', dest="cache_size", help="MB of decoded chunks to keep in memory for chunks that are used by more than one file (default: 256)", type=int, default=256)
+    parser.add_argument('-j', dest="jobs", help="number of processes to decrypt and decompress chunks with (default: number of CPUs)", type=int, default=cpu_count())
     args = parser.parse_args()
+    args.cache_size *= 1024 * 1024
 
 from steam.core.manifest import DepotManifest
 from steam.core.crypto import symmetric_decrypt
-from chunkstore import Chunkstore
+from chunkstore import ChunkstoreVolumes
+from packstore import depot_packstore
+from chunkcodec import decompress_chunk
+from diff_manifests import diff_files
+
+O_BINARY = getattr(os, "O_BINARY", 0) # windows would translate newlines otherwise
+
+def pwrite(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+def pread(fd, length, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+chunkstore_files = {} # per worker process: path -> open .csd file
+
+def extract_chunk(chunk_path, offset, length, is_encrypted, depotkey=None):
+    # runs in the worker processes: read one chunk, decrypt, decompress and hash it
+    if length < 0: # a whole loose chunk file
+        with open(chunk_path, "rb") as f:
+            data = f.read()
+    else: # a chunk inside a .csd, which stays open for the next chunk
+        if not chunk_path in chunkstore_files:
+            chunkstore_files[chunk_path] = os.open(chunk_path, os.O_RDONLY | O_BINARY)
+        data = pread(chunkstore_files[chunk_path], length, offset)
+    if is_encrypted:
+        data = symmetric_decrypt(data, depotkey)
+    decompressed = decompress_chunk(data)
+    return ("LZMA" if data[:2] == b'VZ' else "Zip"), decompressed, sha1(decompressed).digest()
 
 if __name__ == "__main__":
     path = "./depots/%s/" % args.depotid
@@ -73,17 +111,130 @@ if __name__ == "__main__":
         return False
 
     if args.backup:
-        chunkstores = {}
-        chunks_by_store = {}
-        for csm in glob(args.backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm"):
-            chunkstore = Chunkstore(csm)
-            chunkstore.unpack()
-            for chunk, _ in chunkstore.chunks.items():
-                chunks_by_store[chunk] = csm
-            chunkstores[csm] = chunkstore
-
-    for file in manifest.iter_files():
-        if args.files and not is_match(file): continue
+        # every volume of the depot in the directories of the given backup files
+        volumes = ChunkstoreVolumes(args.depotid, None, list(dict.fromkeys(dirname(backup) or "." for backup in args.backup)))
+        volumes.unpack()
+    else:
+        packstore = depot_packstore(args.depotid)
+
+    def chunk_source(chunk):
+        # where to read a chunk from: (path, offset, length, is_encrypted)
+        if args.backup:
+            chunkstore = volumes.find(chunk.sha)
+            if not chunkstore:
+                return None
+            offset, length = chunkstore.chunks[chunk.sha]
+            return chunkstore.csdname, offset, length, chunkstore.is_encrypted
+        if packstore:
+            location = packstore.find(chunk.sha)
+            if location: return location
+        chunkhex = hexlify(chunk.sha).decode()
+        if exists(path + chunkhex):
+            return path + chunkhex, 0, -1, True
+        elif exists(path + chunkhex + "_decrypted"):
+            return path + chunkhex + "_decrypted", 0, -1, False
+        return None
+
+    open_files = {} # filename -> [file descriptor, chunks still to be written, path written to]
+    def finish_output(file, output):
+        close(output[0])
+        if output[2] != args.dest + "/" + file.filename:
+            replace(output[2], args.dest + "/" + file.filename)
+
+    def write_chunk(file, chunk, archive_type, decompressed):
+        chunkhex = hexlify(chunk.sha).decode()
+        if args.dry_run:
+            print("Testing", file.filename, "(%s) from chunk" % archive_type, chunkhex)
+        else:
+            print("Extracting", file.filename, "(%s) from chunk" % archive_type, chunkhex)
+        refs[chunk.sha] -= 1
+        if refs[chunk.sha] <= 0 and chunk.sha in cache:
+            uncache_chunk(chunk.sha)
+        if not args.dry_run:
+            output = open_files[file.filename]
+            pwrite(output[0], decompressed, chunk.offset)
+            output[1] -= 1
+            if not output[1]:
+                finish_output(file, output)
+                del open_files[file.filename]
+
+    # Decoded chunks that other files still need are kept in an LRU cache, so
+    # a chunk shared by several files is only read and decoded once.
+    refs = Counter() # sha -> number of times the chunk still has to be written
+    cache = OrderedDict() # sha -> (archive type, decompressed data)
+    cache_size, cache_hits = 0, 0
+    def cache_chunk(sha, result):
+        global cache_size
+        if refs[sha] <= 0 or len(result[1]) > args.cache_size: return
+        cache[sha] = result
+        cache_size += len(result[1])
+        while cache_size > args.cache_size:
+            uncache_chunk(next(iter(cache)))
+    def uncache_chunk(sha):
+        global cache_size
+        cache_size -= len(cache.pop(sha)[1])
+
+    # Reading and writing happen here, decrypting, decompressing and hashing
+    # in a process pool. Every chunk is written at its own offset as soon as it is
+    # ready, so chunks can complete in any order.
+    pool = ProcessPoolExecutor(args.jobs)
+    pending = {} # future -> [(file, chunk), ...] waiting for it
+    decoding = {} # sha -> future, so a chunk is never decoded twice at once
+    def drain(limit):
+        while len(pending) > limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                waiting = pending.pop(future)
+                del decoding[waiting[0][1].sha]
+                try:
+                    archive_type, decompressed, digest = future.result()
+                except ValueError as e:
+                    print("ERROR:", e)
+                    exit(1)
+                if digest != waiting[0][1].sha:
+                    print("ERROR: sha1 checksum mismatch (expected %s, got %s)" % (hexlify(waiting[0][1].sha).decode(), hexlify(digest).decode()))
+                result = (archive_type, decompressed)
+                for file, chunk in waiting:
+                    write_chunk(file, chunk, *result)
+                cache_chunk(waiting[0][1].sha, result)
+
+    def submit_chunk(file, chunk, source):
+        global cache_hits
+        if chunk.sha in cache:
+            cache.move_to_end(chunk.sha)
+            cache_hits += 1
+            write_chunk(file, chunk, *cache[chunk.sha])
+        elif chunk.sha in decoding:
+            cache_hits += 1
+            pending[decoding[chunk.sha]].append((file, chunk))
+        else:
+            future = pool.submit(extract_chunk, *source, args.depotkey)
+            pending[future] = [(file, chunk)]
+            decoding[chunk.sha] = future
+            drain(args.jobs * 4)
+
+    copied_chunks, copied_bytes = 0, 0
+    def copy_chunks(fd, old_path, copies):
+        # chunks that are already in the old version of the file are copied
+        # from it instead of being decrypted again; returns the chunks that
+        # didn't match and have to be extracted after all
+        global copied_chunks, copied_bytes
+        failed = []
+        with open(old_path, "rb") as f:
+            for old_chunk, chunk in copies:
+                data = pread(f.fileno(), old_chunk.cb_original, old_chunk.offset)
+                if sha1(data).digest() != chunk.sha:
+                    failed.append(chunk)
+                    continue
+                pwrite(fd, data, chunk.offset)
+                copied_chunks += 1
+                copied_bytes += len(data)
+        return failed
+
+    def extract_file(file, old_file=None, chunks=None):
+        if file.is_directory:
+            if not args.dry_run: makedirs(args.dest + "/" + file.filename, exist_ok=True)
+            return
         target = args.dest + "/" + dirname(file.filename)
         if not args.dry_run:
             try:
@@ -103,67 +254,119 @@ if __name__ == "__main__":
                     except NotADirectoryError or FileExistsError:
                         continue
                     break
+        old_path = args.dest + "/" + file.filename
+        old_chunks = {}
+        if old_file and not args.dry_run and isfile(old_path):
+            for chunk in old_file.chunks:
+                old_chunks[chunk.sha] = chunk
+        if chunks is None:
+            chunks = file.chunks
+        copies = [(old_chunks[chunk.sha], chunk) for chunk in chunks if chunk.sha in old_chunks]
+        chunks = [chunk for chunk in chunks if not chunk.sha in old_chunks]
+        output_path = old_path
+        if not args.dry_run:
+            # updated files are assembled next to the old one, which is only
+            # replaced once every chunk has been written
+            if copies: output_path += ".update"
+            try:
+                fd = os_open(output_path, O_WRONLY | O_CREAT | O_BINARY, 0o666)
+            except IsADirectoryError:
+                return
+            # set the final size up front: regions whose chunks are missing stay
+            # sparse, and chunks can be written in any order
+            ftruncate(fd, file.size)
+            if copies:
+                chunks += copy_chunks(fd, old_path, copies)
+        sources = []
+        for chunk in chunks:
+            source = chunk_source(chunk)
+            if not source:
+                print("missing chunk " + hexlify(chunk.sha).decode())
+                continue
+            if source[3] and not args.depotkey:
+                print("ERROR: chunk %s is encrypted, but no depot key was specified" % hexlify(chunk.sha).decode())
+                exit(1)
+            sources.append((chunk, source))
+        if not args.dry_run:
+            output = [fd, len(sources), output_path]
+            if not sources:
+                finish_output(file, output)
+                return
+            open_files[file.filename] = output
+        for chunk, source in sources:
+            submit_chunk(file, chunk, source)
+
+    def check_file(file):
+        # runs in a thread: returns the chunks of an extracted file that are
+        # missing or don't match their sha1, and whether the file has the right size
         try:
-            for chunk in sorted(file.chunks, key = lambda chunk: chunk.offset):
-                chunkhex = hexlify(chunk.sha).decode()
-                if args.backup:
-                    chunk_data = None
-                    is_encrypted = False
-                    try:
-                        chunkstore = chunkstores[chunks_by_store[chunk.sha]]
-                        chunk_data = chunkstore.get_chunk(chunk.sha)
-                        is_encrypted = chunkstore.is_encrypted
-                    except:
-                        print("missing chunk " + hexlify(chunk.sha).decode())
-                        breakpoint()
-                        continue
-                    if is_encrypted:
-                        if args.depotkey:
-                            decrypted = symmetric_decrypt(chunk_data, args.depotkey)
-                        else:
-                            print("ERROR: chunk %s is encrypted, but no depot key was specified" % chunkhex)
-                            exit(1)
-                    else:
-                        decrypted = chunk_data
-                        chunk_data = None
-
-                else:
-                    if exists(path + chunkhex):
-                        with open(path + chunkhex, "rb") as chunkfile:
-                            if args.depotkey:
-                                decrypted = symmetric_decrypt(chunkfile.read(), args.depotkey)
-                            else:
-                                print("ERROR: chunk %s is encrypted, but no depot key was specified" % chunkhex)
-                                exit(1)
-                    elif exists(path + chunkhex + "_decrypted"):
-                        with open(path + chunkhex + "_decrypted", "rb") as chunkfile:
-                            decrypted = chunkfile.read()
-                    else:
-                        print("missing chunk " + chunkhex)
-                        continue
-                decompressed = None
-                if decrypted[:2] == b'VZ': # LZMA
-                    if args.dry_run:
-                        print("Testing", file.filename, "(LZMA) from chunk", chunkhex)
-                    else:
-                        print("Extracting", file.filename, "(LZMA) from chunk", chunkhex)
-                    decompressed = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, decrypted[7:12])]).decompress(decrypted[12:-9])[:chunk.cb_original]
-                elif decrypted[:2] == b'PK': # Zip
-                    if args.dry_run:
-                        print("Testing", file.filename, "(Zip) from chunk", chunkhex)
-                    else:
-                        print("Extracting", file.filename, "(Zip) from chunk", chunkhex)
-                    zipfile = ZipFile(BytesIO(decrypted))
-                    decompressed = zipfile.read(zipfile.filelist[0])
-                else:
-                    print("ERROR: unknown archive type", decrypted[:2].decode())
-                    exit(1)
-                sha = sha1(decompressed)
-                if sha.digest() != chunk.sha:
-                    print("ERROR: sha1 checksum mismatch (expected %s, got %s)" % (hexlify(chunk.sha).decode(), sha.hexdigest()))
-                if not args.dry_run:
-                    with open(args.dest + "/" + file.filename, "ab") as f:
-                        f.seek(chunk.offset)
-                        f.write(decompressed)
-        except IsADirectoryError:
+            f = open(args.dest + "/" + file.filename, "rb")
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return file, file.chunks, False
+        with f:
+            size_ok = fstat(f.fileno()).st_size == file.size
+            return file, [chunk for chunk in file.chunks if sha1(pread(f.fileno(), chunk.cb_original, chunk.offset)).digest() != chunk.sha], size_ok
+
+    if args.update_from:
+        with open(path + "%s.zip" % args.update_from, "rb") as f:
+            old_manifest = DepotManifest(f.read())
+        if old_manifest.filenames_encrypted:
+            if not args.depotkey:
+                print("ERROR: manifest %s has encrypted filenames, but no depot key was found" % args.update_from)
+                exit(1)
+            old_manifest.decrypt_filenames(args.depotkey)
+        changes = diff_files(old_manifest, manifest)
+    else:
+        changes = (("added", None, file) for file in manifest.iter_files())
+    changes = [change for change in changes if not args.files or is_match(change[2] or change[1])]
+    for status, _, file in changes:
+        if status in ("added", "modified") or (args.repair and status == "unchanged"):
+            refs.update(chunk.sha for chunk in file.chunks)
+    counts = {"added": 0, "modified": 0, "unchanged": 0, "removed": 0}
+    removed, to_check = [], []
+    for status, old_file, file in changes:
+        counts[status] += 1
+        if status == "removed":
+            removed.append(old_file)
+        elif args.repair and status != "modified" and not file.is_directory:
+            to_check.append(file)
+        elif status != "unchanged":
+            extract_file(file, old_file)
+
+    if to_check:
+        # hashing is mostly waiting on the disk, so plain threads are enough
+        # to keep it busy; damaged chunks go through the same process pool
+        # as a normal extraction while the rest is still being checked
+        damaged, damaged_chunks = 0, 0
+        with ThreadPoolExecutor(args.jobs) as hashers:
+            for file, chunks, size_ok in hashers.map(check_file, to_check):
+                if size_ok and not chunks: continue
+                damaged += 1
+                damaged_chunks += len(chunks)
+                print("Repairing" if not args.dry_run else "Damaged", file.filename, "(%s of %s chunks)" % (len(chunks), len(file.chunks)))
+                extract_file(file, chunks=chunks)
+    drain(0)
+    pool.shutdown()
+    if cache_hits:
+        print("%s chunks were shared with other files and only decoded once" % cache_hits)
+    if to_check:
+        print("Checked %s files: %s damaged or missing, %s chunks %s" % (len(to_check), damaged, damaged_chunks, "re-extracted" if not args.dry_run else "to re-extract"))
+
+    # files are only deleted once everything else is in place; going through
+    # them backwards removes the files in a directory before the directory
+    for file in sorted(removed, key=lambda file: file.filename, reverse=True):
+        print("Deleting", file.filename)
+        if args.dry_run: continue
+        try:
+            if file.is_directory:
+                rmdir(args.dest + "/" + file.filename)
+            else:
+                remove(args.dest + "/" + file.filename)
+        except FileNotFoundError:
             pass
+        except OSError as e: # directory not empty, or a file where we expected a directory
+            print("could not delete %s: %s" % (file.filename, e))
+
+    if args.update_from:
+        print("Updated from manifest %s: %s added, %s modified, %s deleted, %s unchanged files; copied %s chunks (%s bytes) from the old files" %
+            (args.update_from, counts["added"], counts["modified"], counts["removed"], counts["unchanged"], copied_chunks, copied_bytes))
@@ -6,7 +6,7 @@ from fnmatch import fnmatch
 from glob import glob
 from hashlib import sha1
 from io import BytesIO
-from os import scandir, makedirs, remove
+from os import scandir, makedirs, remove, replace
 from os.path import dirname, exists
 from pathlib import Path
 from struct import unpack
@@ -18,12 +18,13 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
     parser = ArgumentParser(description='Extract downloaded depots.')
     parser.add_argument('depotid', type=int)
     parser.add_argument('depotkey', type=str, nargs='?')
-    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder)", nargs='?')
+    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder); can be used multiple times for a backup spread over several directories", action="append")
     args = parser.parse_args()
 
 from steam.core.manifest import DepotManifest
 from steam.core.crypto import symmetric_decrypt
-from chunkstore import Chunkstore
+from chunkstore import ChunkstoreVolumes
+from packstore import depot_packstore
 
 if __name__ == "__main__":
     path = "./depots/%s/" % args.depotid
@@ -50,21 +51,14 @@ if __name__ == "__main__":
         print("\033[31mERROR: files are encrypted, but no depot key was specified and no depot_keys.txt or depotkey file exists\033[0m")
         exit(1)
 
-    chunks = {}
     if args.backup:
-        chunkstores = {}
-        chunks_by_store = {}
-        for csm in glob(args.backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm"):
-            chunkstore = Chunkstore(csm)
-            chunkstore.unpack()
-            for chunk, _ in chunkstore.chunks.items():
-                chunks[chunk] = _
-                chunks_by_store[chunk] = csm
-            chunkstores[csm] = chunkstore
+        # every volume of the depot in the directories of the given backup files
+        volumes = ChunkstoreVolumes(args.depotid, None, list(dict.fromkeys(dirname(backup) or "." for backup in args.backup)))
+        volumes.unpack()
     else:
         chunkFiles = [data.name for data in scandir(path) if data.is_file()
-        and not data.name.endswith(".zip")]
-        for name in chunkFiles: chunks[name] = 0
+        and len(data.name.replace("_decrypted", "")) == 40] # skip manifests, journals and partial downloads
+        packstore = depot_packstore(args.depotid)
 
     # print(f"{len(chunks)}")
 
@@ -75,18 +69,33 @@ if __name__ == "__main__":
         except:
             return False
 
+    def backup_chunks():
+        # read each chunkstore front to back instead of seeking around for every chunk
+        for chunkstore in volumes.volumes.values():
+            for sha, data in chunkstore.get_chunks(chunkstore.chunks):
+                yield sha, (chunkstore, data)
+
+    def loose_chunks():
+        for name in chunkFiles:
+            yield name, None
+        if packstore:
+            for sha in packstore:
+                yield sha, None
+
     badfiles = []
  
-    for file, value in chunks.items():
+    for file, value in (backup_chunks() if args.backup else loose_chunks()):
         try:
-                if args.backup:
+                if type(file) == bytes: # from a backup or a packstore
                     chunkhex = hexlify(file).decode()
                     chunk_data = None
                     is_encrypted = False
                     try:
-                        chunkstore = chunkstores[chunks_by_store[file]]
-                        chunk_data = chunkstore.get_chunk(file)
-                        is_encrypted = chunkstore.is_encrypted
+                        if args.backup:
+                            chunkstore, chunk_data = value
+                            is_encrypted = chunkstore.is_encrypted
+                        else:
+                            chunk_data, is_encrypted = packstore.get_chunk(file)
                     except Exception as e:
                         print(f"\033[31mError retrieving chunk\033[0m {chunkhex}: {e}")
                         ##breakpoint()
@@ -138,7 +147,7 @@ if __name__ == "__main__":
                     zipfile = ZipFile(BytesIO(decrypted))
                     decompressed = zipfile.read(zipfile.filelist[0])
                 else:
-                    print("\033[31mERROR: unknown archive type\033[0m", decrypted[:2].decode())
+                    print("\033[31mERROR: unknown archive type\033[0m", bytes(decrypted[:2]).decode())
                     badfiles.append(chunkhex)
                     continue
                     #exit(1)
@@ -149,4 +158,20 @@ if __name__ == "__main__":
         except IsADirectoryError:
             pass
     for bad in badfiles:
-        print(f"{bad}")
\ No newline at end of file
+        print(f"{bad}")
+    if badfiles and not args.backup:
+        # set bad loose chunks aside and take them out of the journals, so the
+        # archiver downloads them again
+        for bad in badfiles:
+            for name in (path + bad, path + bad + "_decrypted"):
+                if exists(name):
+                    replace(name, name + ".bad")
+                    print("moved bad chunk to " + name + ".bad")
+        for journal in glob(path + "*.journal"):
+            with open(journal, "r") as f:
+                lines = f.read().split("\n")
+            kept = [line for line in lines if line and not line in badfiles]
+            if len(kept) < len([line for line in lines if line]):
+                with open(journal + ".tmp", "w") as f:
+                    f.write("".join(line + "\n" for line in kept))
+                replace(journal + ".tmp", journal)
\ No newline at end of file
@@ -6,6 +6,22 @@ from os.path import exists
 from steam.core.manifest import DepotManifest
 from sys import stderr
 
+def diff_files(old, new):
+    # classify the files of two manifests as added, modified, unchanged or
+    # removed; yields (status, old file, new file) in the new manifest's
+    # order, followed by the removed files in the old manifest's order
+    old_files = {}
+    for file in old.iter_files():
+        old_files[file.filename] = file
+    for file in new.iter_files():
+        if not file.filename in old_files.keys():
+            yield "added", None, file
+            continue
+        old_file = old_files.pop(file.filename)
+        yield ("modified" if old_file.chunks != file.chunks else "unchanged"), old_file, file
+    for file in old_files.values():
+        yield "removed", file, None
+
 if __name__ == "__main__":
     parser = ArgumentParser(description='Generates a diff (comparison of changes) of two versions (manifests) of a Steam depot.')
     parser.add_argument("depotid", type=int, help="Depot ID to diff.")
@@ -40,11 +56,9 @@ if __name__ == "__main__":
             exit(1)
 
     format_bytes = lambda num_bytes: f"{num_bytes:,} {'byte' if num_bytes == 1 else 'bytes'}"
-    old_files = {}
     old_chunks = {}
     old_size_original, old_size_compressed = 0, 0
     for file in old.iter_files():
-        old_files[file.filename] = file
         for chunk in file.chunks:
             if not chunk.sha in old_chunks.keys():
                 old_chunks[chunk.sha] = chunk
@@ -58,7 +72,10 @@ if __name__ == "__main__":
     num_deleted_chunks, size_deleted_chunks = 0, 0
     new_size_original, new_size_compressed = 0, 0
     chunks_found = []
-    for file in new.iter_files():
+    for status, old_file, file in diff_files(old, new):
+        if status == "removed":
+            if not args.quiet: print(f"deleted file {old_file.filename}")
+            continue
         for chunk in file.chunks:
             if not chunk.sha in old_chunks.keys():
                 if not chunk.sha in chunks_found:
@@ -76,25 +93,20 @@ if __name__ == "__main__":
                     size_reused_chunks += chunk.cb_original
                     new_size_original += chunk.cb_original
                     new_size_compressed += chunk.cb_compressed
-        if not file.filename in old_files.keys():
+        if status == "added":
             if args.quiet:
                 print(file.filename)
             else:
                 print(f"added file {file.filename} ({format_bytes(file.size)} in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'})")
-        else:
-            old_file = old_files[file.filename]
-            del old_files[file.filename]
-            if old_file.chunks != file.chunks:
-                if args.quiet:
-                    print(file.filename)
-                else:
-                    print(f"modified file {file.filename}")
-                    print(f"\told: {format_bytes(old_file.size)} in {len(old_file.chunks)} {'chunk' if len(old_file.chunks) == 1 else 'chunks'}")
-                    size_diff = file.size - old_file.size
-                    print(f"\tnew: {format_bytes(file.size)} ({'+' if size_diff > 0 else '+-' if size_diff == 0 else ''}{size_diff} {'byte' if size_diff == 1 else 'bytes'}) in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'}")
+        elif status == "modified":
+            if args.quiet:
+                print(file.filename)
+            else:
+                print(f"modified file {file.filename}")
+                print(f"\told: {format_bytes(old_file.size)} in {len(old_file.chunks)} {'chunk' if len(old_file.chunks) == 1 else 'chunks'}")
+                size_diff = file.size - old_file.size
+                print(f"\tnew: {format_bytes(file.size)} ({'+' if size_diff > 0 else '+-' if size_diff == 0 else ''}{size_diff} {'byte' if size_diff == 1 else 'bytes'}) in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'}")
     if not args.quiet:
-        for filename, file in old_files.items():
-            print(f"deleted file {filename}")
         print("End list of changed files.")
         for _, chunk in old_chunks.items():
             num_deleted_chunks += 1
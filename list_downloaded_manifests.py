@@ -5,6 +5,7 @@ from datetime import datetime
 from os import listdir
 from os.path import exists
 from vdf import loads
+from packstore import depot_packstore
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
     parser = ArgumentParser(description='Print information about downloaded depots and manifests.\nSpecify either depots and/or manifests to print information on, or one or more apps to see whether their latest depots are downloaded.\nIf neither is specified, the script will print information on all downloaded depot manifests.')
@@ -127,7 +128,7 @@ def print_branches(appinfo, search_chunks=True):
         for index, depot in enumerate(depots):
             if not depot in depot_files.keys():
                 try:
-                    depot_files[depot] = listdir("./depots/%s/" % depot)
+                    depot_files[depot] = depot_contents(depot)
                 except FileNotFoundError:
                     print("\t\t[Missing depot " + str(depot) + ("(%s).]" % (depot_names[depot]) if depot_names[depot] else ".]"))
                     continue
@@ -185,6 +186,15 @@ def print_depot_info(depotid, depot_files, manifests=None, print_not_exists=True
                 print("\t\tDepot %s not found" % depotid)
             return False
 
+def depot_contents(depotid):
+    # everything in a depot's folder, with chunks kept in pack files listed
+    # as if they were loose
+    contents = set(listdir("./depots/%s/" % depotid))
+    packstore = depot_packstore(depotid)
+    if packstore:
+        for sha in packstore: contents.add(hexlify(sha).decode())
+    return contents
+
 def print_manifest_info(depotid, manifestid, depot_files, print_not_exists=True, name=None, search_chunks=True):
     manifests = []
     manifest_zip = "./depots/%s/%s.zip" % (depotid, manifestid)
@@ -228,7 +238,7 @@ if __name__ == "__main__":
             print_app_info(app, args.duplicate_appinfo, args.search_chunks)
     elif args.depotid:
         for depot in args.depotid:
-            print_depot_info(depot, listdir("./depots/%s/" % depot), args.manifestid, search_chunks=args.search_chunks)
+            print_depot_info(depot, depot_contents(depot), args.manifestid, search_chunks=args.search_chunks)
     else:
         for depot in sorted([int(x) for x in listdir("./depots/")]):
-            print_depot_info(depot, listdir("./depots/%s/" % depot), args.manifestid, print_not_exists=False, search_chunks=args.search_chunks)
+            print_depot_info(depot, depot_contents(depot), args.manifestid, print_not_exists=False, search_chunks=args.search_chunks)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import unhexlify
+from os import listdir, remove, scandir
+from os.path import isdir
+from sys import stderr
+from packstore import Packstore
+
+def is_chunk(name):
+    name = name.replace("_decrypted", "")
+    if len(name) != 40: return False # manifests, journals, partial downloads
+    try:
+        unhexlify(name)
+        return True
+    except ValueError:
+        return False
+
+def migrate_depot(depotid, keep=False, max_pack_size=None):
+    depot_dir = "./depots/%s/" % depotid
+    packstore = Packstore(depot_dir + "packs", max_pack_size) if max_pack_size else Packstore(depot_dir + "packs")
+    # encrypted chunks first, so they win if a depot has both versions of a chunk
+    chunks = sorted((chunk for chunk in scandir(depot_dir) if chunk.is_file() and is_chunk(chunk.name)),
+        key=lambda chunk: chunk.name.endswith("_decrypted"))
+    added, size = 0, 0
+    packed, kept = [], 0 # files whose content is in the packs, files that have to stay
+    for chunk in chunks:
+        sha, is_encrypted = unhexlify(chunk.name.replace("_decrypted", "")), not chunk.name.endswith("_decrypted")
+        if packstore.add_file(sha, chunk.path, is_encrypted):
+            added += 1
+            size += chunk.stat().st_size
+            packed.append(chunk)
+        elif packstore.find(sha)[3] == is_encrypted: # packed by an earlier run
+            packed.append(chunk)
+        else: # the other version of the chunk is packed, and a decrypted one can't be made from an encrypted one without the key
+            kept += 1
+    # only delete anything once the pack index is safely on disk
+    packstore.close()
+    if not keep:
+        for chunk in packed:
+            remove(chunk.path)
+    print("depot %s: moved %s chunks (%s bytes) into %s%s%s" % (depotid, added, size, packstore.directory,
+        "" if added + kept == len(chunks) else ", %s were already packed" % (len(chunks) - added - kept),
+        "" if not kept else ", kept %s loose chunks whose other version is packed" % kept))
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Move the loose chunks of downloaded depots (one file per chunk in depots/<depotid>/) into pack files.')
+    parser.add_argument("depots", type=int, nargs="*", help="Depots to migrate; if omitted, every depot in the depots folder is migrated")
+    parser.add_argument("-k", help="Keep the loose chunk files after packing them", dest="keep", action="store_true")
+    parser.add_argument("-s", type=int, help="Start a new pack file when one would grow past this many MB, default 4096", dest="pack_size", nargs="?")
+    args = parser.parse_args()
+    depots = args.depots or sorted(int(depot) for depot in listdir("./depots/") if depot.isdigit())
+    for depot in depots:
+        if not isdir("./depots/%s" % depot):
+            print("depot %s not found" % depot, file=stderr)
+            continue
+        migrate_depot(depot, args.keep, args.pack_size * 1024 * 1024 if args.pack_size else None)
@@ -1,31 +1,83 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
 from os import scandir, makedirs, remove
-from os.path import exists
+from os.path import dirname, exists
 from struct import pack, unpack, iter_unpack
 from vdf import dumps
 from sys import stderr
-from chunkstore import Chunkstore
+import os
+from steam.core.manifest import DepotManifest
+from chunkstore import ChunkstoreVolumes, manifest_chunk_order
 
-def pack_backup(depot, destdir, decrypted=False, no_update=False):
-    csd_target = destdir + "/" + str(depot) + "_depotcache_1.csd"
-    csm_target = destdir + "/" + str(depot) + "_depotcache_1.csm"
-    depot_dir = "./depots/" + str(depot)
-    mode = "wb"
+class PackProgress():
+    # a single progress line for all the depots being packed, instead of a
+    # line per chunk
+    def __init__(self):
+        self.lock = Lock()
+        self.chunks, self.chunks_total = 0, 0
+        self.bytes, self.bytes_total = 0, 0
+        self.start = self.last_print = monotonic()
+        self.last_msg_length = 0
+    def add_total(self, chunks, length):
+        with self.lock:
+            self.chunks_total += chunks
+            self.bytes_total += length
+    def update(self, length):
+        with self.lock:
+            self.chunks += 1
+            self.bytes += length
+            now = monotonic()
+            if now - self.last_print < 1 and self.chunks < self.chunks_total:
+                return
+            self.last_print = now
+            speed = round(self.bytes / max(now - self.start, 0.001) / 1000000, 2)
+            msg = f"\rPacking at {speed}MB/s ({self.chunks}/{self.chunks_total} chunks, {round(self.bytes / 1000000)}/{round(self.bytes_total / 1000000)} MB)"
+            print(msg + " " * max(0, self.last_msg_length - len(msg)), end="", flush=True)
+            self.last_msg_length = len(msg)
 
-    if exists(csm_target) and exists(csd_target):
-        if no_update: # don't want to update the old files, delete them
-            remove(csd_target)
-            remove(csm_target)
-            mode = "wb"
-        else:
-            chunkstore = Chunkstore(csd_target, depot, not decrypted)
-            chunkstore.unpack()
-            mode = "ab"
-    else:
-        chunkstore = Chunkstore(csd_target, depot, not decrypted)
+def prefetch(filename):
+    # ask the OS to start reading a chunk that is about to be copied
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
+def manifest_order(depot, manifest, chunks):
+    # lay chunks out in the order the manifest's files use them, so reading
+    # the backup back file by file is mostly sequential; chunks the manifest
+    # doesn't use go at the end
+    manifest_path = "./depots/%s/%s.zip" % (depot, manifest)
+    if not exists(manifest_path):
+        print("manifest %s not found, packing depot %s in directory order" % (manifest_path, depot), file=stderr)
+        return chunks
+    with open(manifest_path, "rb") as f:
+        manifest = DepotManifest(f.read())
+    ordered = {}
+    for sha in manifest_chunk_order(manifest):
+        if sha in chunks and not sha in ordered:
+            ordered[sha] = chunks[sha]
+    for sha, chunk in chunks.items():
+        if not sha in ordered:
+            ordered[sha] = chunk
+    return ordered
+
+def pack_backup(depot, destdirs, decrypted=False, no_update=False, volume_size=None, progress=None, readers=None, readahead=32, manifest=None):
+    depot_dir = "./depots/" + str(depot)
+    volumes = ChunkstoreVolumes(depot, not decrypted, destdirs, volume_size)
+    if no_update: # don't want to update the old files, delete them
+        for volume in volumes.volumes.values():
+            for name in (volume.csdname, volume.csmname, volume.csjname):
+                if exists(name): remove(name)
+        volumes = ChunkstoreVolumes(depot, not decrypted, destdirs, volume_size)
+    volumes.unpack()
 
     if decrypted:
         chunk_match = lambda chunk: chunk.endswith("_decrypted")
@@ -39,50 +91,59 @@ def pack_backup(depot, destdir, decrypted=False, no_update=False):
         except:
             return False
 
-    chunks = [chunk.name for chunk in scandir(depot_dir) if chunk.is_file()
-            and not chunk.name.endswith(".zip")
-            and chunk_match(chunk.name)
-            and is_hex(chunk.name.replace("_decrypted",""))
-            and not unhexlify(chunk.name.replace("_decrypted","")) in chunkstore.chunks.keys()]
-    with open(csd_target, mode) as csd:
-        # iterate over chunks
-        chunks_added = 0
-        for chunk in chunks:
-            csd.seek(0, 2)
-            offset = csd.tell()
+    chunks = {}
+    for chunk in scandir(depot_dir):
+        name = chunk.name.replace("_decrypted","")
+        if (chunk.is_file() and chunk_match(chunk.name) and len(name) == 40 and is_hex(name)
+            and not unhexlify(name) in volumes):
+            chunks[unhexlify(name)] = chunk
+    if manifest:
+        chunks = manifest_order(depot, manifest, chunks)
+    plan = volumes.plan((sha, chunk.stat().st_size) for sha, chunk in chunks.items())
+    progress = progress or PackProgress()
+    progress.add_total(len(chunks), sum(chunk.stat().st_size for chunk in chunks.values()))
 
-            with open("./depots/" + str(depot) + "/" + chunk, "rb") as chunkfile:
-                # get length of chunk
-                chunkfile.seek(0, 2)
-                length = chunkfile.tell()
-                chunkfile.seek(0)
+    def pack_volume(number, shas):
+        volume = volumes.volume(number)
+        for i, sha in enumerate(shas):
+            if readers and not i % readahead:
+                # the reader threads warm the cache for the next batch while this one is copied
+                for upcoming in shas[i + readahead:i + 2 * readahead]:
+                    readers.submit(prefetch, chunks[upcoming].path)
+            _, length = volume.append_file(sha, chunks[sha].path)
+            progress.update(length)
+        volume.close()
 
-                # write chunk content to csd
-                csd.write(chunkfile.read())
+    def pack_directory(numbers):
+        for number in numbers:
+            pack_volume(number, plan[number])
 
-            # write chunk location to csm
-            if decrypted:
-                chunkstore.chunks[unhexlify(chunk.replace("_decrypted",""))] = (offset, length)
-            else:
-                chunkstore.chunks[unhexlify(chunk)] = (offset, length)
-            chunks_added += 1
-            print(f"depot {depot}: added chunk {chunk} ({chunks_added}/{len(chunks)})")
-        print("writing index...")
-        chunkstore.write_csm()
-        print("packed", len(chunks), "chunk" if len(chunks) == 1 else "chunks")
-        csd.seek(0, 2)
-        return csd.tell()
+    # volumes go round-robin to the destination directories; one job per
+    # directory packs its volumes one after another, so each disk is written
+    # sequentially by a single thread
+    by_directory = {}
+    for number in plan:
+        by_directory.setdefault(dirname(volumes.volume(number).csdname), []).append(number)
+    with ThreadPoolExecutor(len(by_directory) or 1) as pool:
+        for result in [pool.submit(pack_directory, numbers) for numbers in by_directory.values()]:
+            result.result()
+    print("\ndepot %s: packed %s %s" % (depot, len(chunks), "chunk" if len(chunks) == 1 else "chunks"))
+    return volumes.sizes()
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Pack a SteamPipe backup (.csd/.csm files, and optionally an sku.sis file defining the backup) from individual chunks in the depots/ folder.')
     parser.add_argument("-a", dest="appid", type=int, help="App ID for sku file (if ommitted, no sku will be generated)", nargs="?")
-    parser.add_argument("-d", dest="depots", metavar=('depot', 'manifest'), action="append", type=int, help="Depot ID to pack, can be used multiple times. Include a manifest ID too if generating an sku.sis", nargs='+')
+    parser.add_argument("-d", dest="depots", metavar=('depot', 'manifest'), action="append", type=int, help="Depot ID to pack, can be used multiple times. Include a manifest ID too if generating an sku.sis; chunks are then packed in the order the manifest's files use them", nargs='+')
     parser.add_argument("-n", dest="name", default="steamarchiver backup", type=str, help="Backup name")
     parser.add_argument("--decrypted", action='store_true', help="Use decrypted chunks to pack backup", dest="decrypted")
     parser.add_argument("--no-update", action='store_true', help="If an existing backup is found, DELETE it instead of updating it", dest="no_update")
-    parser.add_argument("--destdir", help="Directory to put sis/csm/csd files in", default=".")
+    parser.add_argument("--destdir", help="Directory to put sis/csm/csd files in; can be used multiple times to spread the chunkstores over several disks. For Steam and unpack_sis.py to find every volume, name them Disk_1, Disk_2, ... in one folder; depot_extractor.py and depot_validator.py take one -b per directory", action="append")
+    parser.add_argument("-j", dest="jobs", type=int, help="Number of depots to pack at the same time, default 4", default=4)
+    parser.add_argument("-s", dest="volume_size", type=int, help="Start a new chunkstore (_2, _3, ...) when one would grow past this many MB", nargs="?")
     args = parser.parse_args()
-    makedirs(args.destdir, exist_ok=True)
+    args.destdir = args.destdir or ["."]
+    for destdir in args.destdir:
+        makedirs(destdir, exist_ok=True)
     if args.depots == None:
         print("must specify at least one depot", file=stderr)
         parser.print_usage()
@@ -93,7 +154,7 @@ if __name__ == "__main__":
         write_sku = True
         sku = {"sku":
                 {"name":args.name,
-                "disks":"1",
+                "disks":str(len(args.destdir)),
                 "disk":"1",
                 "backup":"1" if args.decrypted else "0",
                 "contenttype":"3",
@@ -105,6 +166,11 @@ if __name__ == "__main__":
                 "chunkstores":{}
               }
         }
+    progress = PackProgress()
+    # prefetching only makes sense where we can ask the OS to read ahead for us
+    readers = ThreadPoolExecutor(8) if hasattr(os, "posix_fadvise") else None
+    packers = ThreadPoolExecutor(args.jobs)
+    packed = []
     for depot_tuple in args.depots:
         if len(depot_tuple) == 2:
             depot, manifest = depot_tuple
@@ -118,10 +184,19 @@ if __name__ == "__main__":
             else:
                 sku["sku"]["depots"][len(sku["sku"]["depots"])] = str(depot)
                 sku["sku"]["manifests"][str(depot)] = str(manifest)
-        size = pack_backup(depot, args.destdir, args.decrypted, args.no_update)
+        packed.append((depot, packers.submit(pack_backup, depot, args.destdir, args.decrypted, args.no_update,
+            args.volume_size * 1024 * 1024 if args.volume_size else None, progress, readers, manifest=manifest)))
+    for depot, result in packed:
+        sizes = result.result()
         if write_sku:
-            sku["sku"]["chunkstores"][str(depot)] = {"1":str(size)}
+            sku["sku"]["chunkstores"][str(depot)] = {str(number): str(size) for number, size in sizes.items()}
+    packers.shutdown()
+    if readers:
+        readers.shutdown()
     if write_sku:
-        with open(args.destdir + "/sku.sis", "w") as skufile:
-            skufile.write(dumps(sku))
-            print("wrote sku.sis")
+        # every disk gets a copy of the sku, numbered like a retail master's
+        for disk, destdir in enumerate(args.destdir, 1):
+            sku["sku"]["disk"] = str(disk)
+            with open(destdir + "/sku.sis", "w") as skufile:
+                skufile.write(dumps(sku))
+                print("wrote", destdir + "/sku.sis")
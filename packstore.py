@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+from glob import glob
+from os import fsync, makedirs, path, remove, replace
+from struct import iter_unpack, pack, unpack_from
+from sys import argv
+from time import monotonic
+import os
+
+from chunkstore import ChunkIndex, copy_range
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError: # windows: can't tell a dead writer's log from a live one
+    flock = None
+
+# A depot's chunks kept in append-only pack files under depots/<depot>/packs/
+# instead of one file per chunk:
+#   <n>.pack  chunk data, back to back
+#   <n>.idx   header, chunk count, then 36-byte records (sha, offset, flags,
+#             length) sorted by sha, written once the pack is complete
+#   <n>.log   the same records in the order the chunks were written, for a
+#             pack that is still being written; a log whose writer died is
+#             turned into an index the next time the packstore is loaded
+# Every writer claims a new pack number and locks its pack, so several
+# archivers can add to the same depot at once.
+IDX_HEADER = b"SAPI\x01\x00\x00\x00"
+PACK_DECRYPTED = 1 # flag for chunks that were stored decrypted
+
+def tag_records(number, records):
+    # put the pack number into the flags field of every record (above the
+    # PACK_DECRYPTED bit), so the records of every pack fit in one index
+    count = len(records) // 36
+    tag = number << 1
+    records = bytearray(records)
+    records[28::36] = records[28::36].translate(bytes((tag | flags & PACK_DECRYPTED) & 0xff for flags in range(256)))
+    for byte in range(1, 4):
+        records[28 + byte::36] = bytes([tag >> byte * 8 & 0xff]) * count
+    return bytes(records)
+
+def pread(fd, length, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+class Packstore():
+    def __init__(self, directory, max_pack_size=4 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_pack_size = max_pack_size
+        self.index = ChunkIndex() # chunks of every finished pack, with their pack number in the flags
+        self.logged = {} # sha -> (pack number, offset, length, flags) for packs this packstore wrote or that are still being written
+        self.files = {} # pack number -> file descriptor, for reading
+        self.writer = None # [pack number, file descriptor, log file, size]
+        self.unsynced, self.last_sync = 0, monotonic()
+        self.load()
+    def __repr__(self):
+        return f"Packstore {self.directory}: {len(self)} chunks in {len(self.numbers())} packs"
+    def numbers(self):
+        return sorted(int(path.basename(name)[:-5]) for name in glob(path.join(self.directory, "*.pack"))
+            if path.basename(name)[:-5].isdigit())
+    def filename(self, number, extension):
+        return path.join(self.directory, "%s.%s" % (number, extension))
+    def load(self):
+        self.logged, records = {}, []
+        for number in self.numbers():
+            if not path.exists(self.filename(number, "idx")) and path.exists(self.filename(number, "log")):
+                self.recover(number)
+            if path.exists(self.filename(number, "idx")):
+                with open(self.filename(number, "idx"), "rb") as f:
+                    data = f.read()
+                if data[:8] != IDX_HEADER:
+                    print("not a pack index: " + self.filename(number, "idx"))
+                    continue
+                records.append(tag_records(number, data[16:16 + unpack_from("<Q", data, 8)[0] * 36]))
+        self.index = ChunkIndex(b"".join(records))
+    def read_log(self, number):
+        # the records of a pack's log whose chunk data made it to disk
+        pack_size = path.getsize(self.filename(number, "pack"))
+        with open(self.filename(number, "log"), "rb") as f: records = f.read()
+        records = records[:len(records) - len(records) % 36]
+        for i, (_, offset, _, length) in enumerate(iter_unpack("<20s Q L L", records)):
+            if offset + length > pack_size:
+                return records[:i * 36]
+        return records
+    def recover(self, number):
+        # finish the pack of a writer that died; a pack that is still being
+        # written is locked, and its chunks are only read from its log
+        fd = os.open(self.filename(number, "pack"), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            if flock:
+                try:
+                    flock(fd, LOCK_EX | LOCK_NB)
+                    if path.exists(self.filename(number, "log")): # unless another loader got there first
+                        print("finishing pack %s left behind by an interrupted writer" % self.filename(number, "pack"))
+                        self.write_index(number, self.read_log(number))
+                    return
+                except BlockingIOError:
+                    pass
+            for sha, offset, flags, length in iter_unpack("<20s Q L L", self.read_log(number)):
+                self.logged.setdefault(sha, (number, offset, length, flags))
+        finally:
+            os.close(fd)
+    def write_index(self, number, records):
+        # sort a pack's log records into its index, then drop the log
+        index = ChunkIndex(records)
+        with open(self.filename(number, "idx") + ".tmp", "wb") as f:
+            f.write(IDX_HEADER + pack("<Q", index.count) + index.records)
+            f.flush()
+            fsync(f.fileno())
+        replace(self.filename(number, "idx") + ".tmp", self.filename(number, "idx"))
+        remove(self.filename(number, "log"))
+    def find(self, sha):
+        # returns (pack file, offset, length, is_encrypted), or None
+        if sha in self.logged:
+            number, offset, length, flags = self.logged[sha]
+        elif sha in self.index:
+            offset, length = self.index[sha]
+            flags = self.index.flags(sha)
+            number = flags >> 1
+        else:
+            return None
+        return self.filename(number, "pack"), offset, length, not flags & PACK_DECRYPTED
+    def __contains__(self, sha):
+        return sha in self.logged or sha in self.index
+    def __len__(self):
+        return len(self.logged) + len(self.index)
+    def __iter__(self):
+        yield from self.logged
+        yield from self.index
+    def get_chunk(self, sha):
+        # returns (data, is_encrypted)
+        location = self.find(sha)
+        if not location:
+            raise KeyError(sha)
+        filename, offset, length, is_encrypted = location
+        if not filename in self.files:
+            self.files[filename] = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        return pread(self.files[filename], length, offset), is_encrypted
+    def open_writer(self):
+        makedirs(self.directory, exist_ok=True)
+        number = max(self.numbers(), default=0) + 1
+        while True:
+            try:
+                fd = os.open(self.filename(number, "pack"), os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+                break
+            except FileExistsError: # another writer got there first
+                number += 1
+        if flock:
+            flock(fd, LOCK_EX) # until the pack is closed, so nobody takes its log for a dead writer's
+        self.writer = [number, fd, open(self.filename(number, "log"), "ab"), 0]
+    def add_chunk(self, sha, data, is_encrypted=True):
+        def write(fd, offset):
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+        return self.add(sha, len(data), is_encrypted, write)
+    def add_file(self, sha, filename, is_encrypted=True):
+        # copies a loose chunk file into the pack without passing through python where possible
+        with open(filename, "rb") as f:
+            length = os.fstat(f.fileno()).st_size
+            return self.add(sha, length, is_encrypted, lambda fd, offset: copy_range(f.fileno(), fd, 0, offset, length))
+    def add(self, sha, length, is_encrypted, write, sync_records=256, sync_seconds=5):
+        if sha in self: return False
+        if self.writer and self.writer[3] and self.writer[3] + length > self.max_pack_size:
+            self.close()
+        if not self.writer:
+            self.open_writer()
+        number, fd, log, offset = self.writer
+        if write(fd, offset) != length:
+            raise IOError("short write to " + self.filename(number, "pack"))
+        self.writer[3] += length
+        flags = 0 if is_encrypted else PACK_DECRYPTED
+        log.write(pack("<20s Q L L", sha, offset, flags, length))
+        self.logged[sha] = (number, offset, length, flags)
+        self.unsynced += 1
+        if self.unsynced >= sync_records or monotonic() - self.last_sync >= sync_seconds:
+            self.sync()
+        return True
+    def sync(self):
+        # the chunk data has to be on disk before the log records pointing to it
+        if not self.writer: return
+        fsync(self.writer[1])
+        self.writer[2].flush()
+        fsync(self.writer[2].fileno())
+        self.unsynced, self.last_sync = 0, monotonic()
+    def close(self):
+        # finish the pack being written: sort its log into an index
+        # (its chunks stay in self.logged, they're only merged into the index on the next load)
+        if self.writer:
+            self.sync()
+            number, fd, log, _ = self.writer
+            log.close()
+            self.writer = None
+            self.write_index(number, b"".join(pack("<20s Q L L", sha, offset, flags, length)
+                for sha, (pack_number, offset, length, flags) in self.logged.items() if pack_number == number))
+            os.close(fd) # releases the lock
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+
+def depot_packstore(depotid):
+    # the packstore of a depot in the depots/ folder, if it has one
+    directory = "./depots/%s/packs" % depotid
+    return Packstore(directory) if path.isdir(directory) else None
+
+if __name__ == "__main__":
+    if len(argv) > 1:
+        print(Packstore(argv[1] if not argv[1].isdigit() else "./depots/%s/packs" % argv[1]))
@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+from struct import pack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chunkstore import ChunkIndex, ChunkstoreVolumes
+
+def record(sha, offset, length, flags=0):
+    return pack("<20s Q L L", sha, offset, flags, length)
+
+class ChunkIndexTest(unittest.TestCase):
+    def test_unsorted_records(self):
+        shas = [bytes([i]) * 20 for i in (5, 3, 9, 1)]
+        # same first 8 bytes, different sha
+        shas.append(bytes([3]) * 8 + bytes([4]) * 12)
+        records = b"".join(record(sha, i, 10) for i, sha in enumerate(shas)) + record(shas[0], 99, 10)
+        index = ChunkIndex(records)
+        self.assertEqual(list(index), sorted(shas))
+        self.assertEqual(index[shas[0]], (0, 10))
+        self.assertNotIn(bytes([2]) * 20, index)
+
+    def test_mapping_api(self):
+        shas = [bytes([i]) * 20 for i in (4, 2, 8)]
+        index = ChunkIndex(b"".join(record(sha, i, 10) for i, sha in enumerate(shas)))
+        self.assertEqual(list(index.keys()), sorted(shas))
+        self.assertEqual(list(iter(index)), sorted(shas))
+        self.assertEqual(dict(index.items())[shas[1]], (1, 10))
+
+    def test_unsorted_tail(self):
+        shas = sorted(bytes([i]) * 20 for i in range(1, 100))
+        records = b"".join(record(sha, i, 10) for i, sha in enumerate(shas))
+        index = ChunkIndex(records + record(b"\0" * 20, 1000, 10, 3) + record(shas[5], 2000, 10))
+        self.assertEqual(index.count, len(shas))
+        self.assertEqual(len(index), len(shas) + 1)
+        self.assertEqual(index[shas[5]], (5, 10))
+        self.assertEqual(index.flags(b"\0" * 20), 3)
+        index[shas[7]] = (3000, 20)
+        merged = ChunkIndex(index.sorted_records())
+        self.assertEqual(merged.count, len(index))
+        self.assertEqual(dict(merged.items()), dict(index.items()))
+
+class ChunkstoreVolumesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def volumes(self):
+        volumes = ChunkstoreVolumes(1234, True, [self.tmp.name])
+        volumes.unpack()
+        return volumes
+
+    def test_crash_before_first_csm(self):
+        volumes = self.volumes()
+        volumes.append_chunk(b"a" * 20, b"A" * 300)
+        volume = volumes.volumes[1]
+        volume.sync()
+        # crash: the files are left as they are, no CSM was ever written
+        volume.csdfile.close()
+        volume.journal.close()
+        self.assertFalse(os.path.exists(volume.csmname))
+
+        volumes = self.volumes()
+        self.assertIn(b"a" * 20, volumes)
+        volumes.append_chunk(b"b" * 20, b"B" * 100)
+        volumes.close()
+
+        volumes = self.volumes()
+        volume = volumes.volumes[1]
+        self.assertFalse(os.path.exists(volume.csjname))
+        self.assertEqual(len(volume.chunks), 2)
+        self.assertEqual(bytes(volume.get_chunk(b"a" * 20)), b"A" * 300)
+        self.assertEqual(bytes(volume.get_chunk(b"b" * 20)), b"B" * 100)
+        volume.close_reader()
+
+if __name__ == "__main__":
+    unittest.main()
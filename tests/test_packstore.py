@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from packstore import Packstore
+
+class PackstoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = os.path.join(self.tmp.name, "packs")
+
+    def test_chunks_from_several_packs(self):
+        for i in range(3):
+            packstore = Packstore(self.directory)
+            packstore.add_chunk(bytes([i]) * 20, b"chunk %d" % i, is_encrypted=i != 1)
+            packstore.close()
+        packstore = Packstore(self.directory)
+        self.assertEqual(len(packstore), 3)
+        for i in range(3):
+            self.assertEqual(packstore.get_chunk(bytes([i]) * 20), (b"chunk %d" % i, i != 1))
+            self.assertTrue(packstore.find(bytes([i]) * 20)[0].endswith("%s.pack" % (i + 1)))
+        packstore.close()
+
+    def test_interrupted_writer(self):
+        packstore = Packstore(self.directory)
+        packstore.add_chunk(b"a" * 20, b"A" * 300)
+        packstore.sync()
+        # crash: the pack and its log are left as they are
+        os.close(packstore.writer[1])
+        packstore.writer[2].close()
+
+        packstore = Packstore(self.directory)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "1.log")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "1.idx")))
+        self.assertEqual(packstore.get_chunk(b"a" * 20), (b"A" * 300, True))
+        packstore.close()
+
+    @unittest.skipIf(os.name == "nt", "no locking on windows")
+    def test_live_writer(self):
+        writer = Packstore(self.directory)
+        writer.add_chunk(b"a" * 20, b"A" * 300)
+        writer.sync()
+        reader = Packstore(self.directory)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "1.log")))
+        self.assertEqual(reader.get_chunk(b"a" * 20), (b"A" * 300, True))
+        reader.close()
+        writer.close()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "1.log")))
+
+if __name__ == "__main__":
+    unittest.main()
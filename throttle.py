@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+from asyncio import Condition, sleep
+from random import uniform
+from time import monotonic
+
+class AdaptiveLimiter():
+    # AIMD concurrency limit: the limit goes up by one every interval while
+    # throughput keeps improving, and is halved on errors, timeouts and 429s
+    def __init__(self, limit, maximum=None, minimum=1, interval=5):
+        self.limit = float(limit)
+        self.maximum = max(maximum or limit, limit)
+        self.minimum = minimum
+        self.interval = interval
+        self.active = 0
+        self.condition = Condition()
+        self.window_start = monotonic()
+        self.window_bytes = 0
+        self.best_throughput = 0
+        self.last_backoff = 0
+    def __repr__(self):
+        return f"{int(self.limit)} connections"
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            # only wake as many waiters as there are free slots (more than one
+            # if the limit went up in the meantime), not every one of them
+            self.condition.notify(max(0, int(self.limit) - self.active))
+    def record(self, length):
+        self.window_bytes += length
+        now = monotonic()
+        if now - self.window_start < self.interval:
+            return
+        throughput = self.window_bytes / (now - self.window_start)
+        self.window_start, self.window_bytes = now, 0
+        if throughput > self.best_throughput * 1.05:
+            # only probe upwards if we're actually using the connections we have
+            if self.active >= int(self.limit) - 1 and self.limit < self.maximum:
+                self.limit += 1
+            self.best_throughput = throughput
+        else:
+            # let the reference decay so a link that got faster again is noticed
+            self.best_throughput *= 0.95
+    def backoff(self):
+        # several workers usually fail at once; only back off once per interval
+        now = monotonic()
+        if now - self.last_backoff < self.interval:
+            return
+        self.last_backoff = now
+        self.limit = max(self.minimum, self.limit / 2)
+        self.best_throughput = 0
+
+class RateLimiter():
+    # token bucket shared by every download, with up to one second of burst
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = rate
+        self.last = monotonic()
+    async def consume(self, length):
+        now = monotonic()
+        self.available = min(self.rate, self.available + (now - self.last) * self.rate)
+        self.last = now
+        self.available -= length
+        if self.available < 0:
+            await sleep(-self.available / self.rate)
+
+def backoff_delay(attempt, retry_after=None, base=0.5, cap=60):
+    # exponential backoff with jitter, honouring the server's Retry-After
+    if retry_after:
+        try:
+            return min(float(retry_after), cap)
+        except ValueError:
+            pass
+    return uniform(0.5, 1) * min(cap, base * 2 ** attempt)
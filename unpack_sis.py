@@ -8,30 +8,59 @@ from steam.core.crypto import symmetric_encrypt, symmetric_encrypt_with_iv
 from struct import iter_unpack, pack
 from sys import argv
 from vdf import loads
-from chunkstore import Chunkstore
+from chunkstore import Chunkstore, copy_range
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
 
-def unpack_chunkstore(target, key=None, key_hex=None):
-        if key == True:
-            key, key_hex = find_key(depot)
+csd_files = {} # per worker process: path -> open .csd file
+
+def encrypt_chunk(csdname, offset, length, key, filename):
+    # runs in the worker processes: re-encrypt one chunk into a loose file
+    if not csdname in csd_files:
+        csd_files[csdname] = open(csdname, "rb")
+    csd_files[csdname].seek(offset)
+    data = csd_files[csdname].read(length)
+    with open(filename, "wb") as f:
+        f.write(symmetric_encrypt(data, key))
+
+def unpack_chunkstore(target, key=None, key_hex=None, encrypt_pool=None):
         chunkstore = Chunkstore(target)
-        with open(chunkstore.csdname, "rb") as csdfile:
-            def unpacker(chunkstore, sha, offset, length):
-                print("extracting chunk %s from offset %s in file %s" % (hexlify(sha).decode(), offset, target + ".csd"))
-                csdfile.seek(offset)
-                if key:
-                    with open("./depots/%s/%s" % (chunkstore.depot, hexlify(sha).decode()), "wb") as f:
-                        print("writing %s bytes re-encrypted using key %s and random IV" % (length, key_hex))
-                        f.write(symmetric_encrypt(csdfile.read(length), key))
-                elif chunkstore.is_encrypted:
-                    with open("./depots/%s/%s" % (chunkstore.depot, hexlify(sha).decode()), "wb") as f:
-                        print("writing %s bytes encrypted" % length)
-                        f.write(csdfile.read(length))
-                else:
-                    with open("./depots/%s/%s_decrypted" % (chunkstore.depot, hexlify(sha).decode()), "wb") as f:
-                        print("writing %s bytes unencrypted" % length)
-                        f.write(csdfile.read(length))
-            makedirs("./depots/%s" % chunkstore.depot, exist_ok=True)
-            chunkstore.unpack(unpacker)
+        if key == True:
+            key, key_hex = find_key(str(chunkstore.depot))
+        chunkstore.unpack()
+        makedirs("./depots/%s" % chunkstore.depot, exist_ok=True)
+        if key:
+            print("unpacking %s chunks from %s, re-encrypted using key %s and random IVs" % (len(chunkstore.chunks), chunkstore.csdname, key_hex))
+        else:
+            print("unpacking %s %s chunks from %s" % (len(chunkstore.chunks), "encrypted" if chunkstore.is_encrypted else "unencrypted", chunkstore.csdname))
+        # go through the CSD front to back so the source disk reads sequentially
+        chunks = sorted(chunkstore.chunks.items(), key=lambda item: item[1][0])
+        if key:
+            own_pool = not encrypt_pool
+            encrypt_pool = encrypt_pool or ProcessPoolExecutor()
+            results = deque()
+            for sha, (offset, length) in chunks:
+                results.append(encrypt_pool.submit(encrypt_chunk, chunkstore.csdname, offset, length, key,
+                    "./depots/%s/%s" % (chunkstore.depot, hexlify(sha).decode())))
+                if len(results) > 256: # don't queue up a future for every chunk at once
+                    results.popleft().result()
+            for result in results:
+                result.result()
+            if own_pool:
+                encrypt_pool.shutdown()
+        else:
+            suffix = "" if chunkstore.is_encrypted else "_decrypted"
+            with open(chunkstore.csdname, "rb") as csdfile:
+                for sha, (offset, length) in chunks:
+                    # copied inside the kernel, without passing through python
+                    fd = os.open("./depots/%s/%s%s" % (chunkstore.depot, hexlify(sha).decode(), suffix), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+                    try:
+                        copy_range(csdfile.fileno(), fd, offset, 0, length)
+                    finally:
+                        os.close(fd)
+        print("unpacked %s chunks from %s" % (len(chunks), chunkstore.csdname))
+        return len(chunks)
 
 def find_key(depot):
     if path.exists("./depot_keys.txt"):
@@ -41,8 +70,8 @@ def find_key(depot):
                 if line[0] == depot:
                     key_hex = line[2]
                     return unhexlify(key_hex), key_hex
-    if not key:
-        print("couldn't find key for depot", depot)
+    print("couldn't find key for depot", depot)
+    return None, None
 
 def unpack_sis(sku, chunkstore_path, use_key = False):
     need_manifests = {}
@@ -50,14 +79,15 @@ def unpack_sis(sku, chunkstore_path, use_key = False):
     if "sku" in sku.keys():
         sku = sku["sku"]
 
-    # unpack each depot
+    # find every chunkstore first, so a missing one is noticed before we start
+    targets = []
     for depot in sku["manifests"]:
         key, key_hex = None, None
         if use_key and sku["backup"] == "1":
             key, key_hex = find_key(depot)
         need_manifests[depot] = sku["manifests"][depot]
         for chunkstore in sku["chunkstores"][depot]:
-            print("unpacking chunkstore %s" % chunkstore)
+            print("locating chunkstore %s of depot %s" % (chunkstore, depot))
             target = chunkstore_path + "/%s_depotcache_%s" % (depot, chunkstore)
             if not path.exists(target + ".csm"):
                 # maybe it's in a disk folder?
@@ -75,8 +105,23 @@ def unpack_sis(sku, chunkstore_path, use_key = False):
                         # welp
                         print("couldn't find depot %s chunkstore %s" % (depot, chunkstore))
                         return False
-            # unpack this chunkstore
-            unpack_chunkstore(target, key, key_hex)
+            targets.append((target, key, key_hex))
+
+    # one thread per source disk (each Disk_N folder or the sku's folder), so
+    # every drive is read sequentially and all drives are busy at once;
+    # re-encryption is shared between them in a process pool
+    disks = {}
+    for target in targets:
+        disks.setdefault(path.dirname(target[0]), []).append(target)
+    encrypt_pool = ProcessPoolExecutor() if any(key for _, key, _ in targets) else None
+    def unpack_disk(targets):
+        for target, key, key_hex in targets:
+            unpack_chunkstore(target, key, key_hex, encrypt_pool)
+    with ThreadPoolExecutor(len(disks) or 1) as pool:
+        for result in [pool.submit(unpack_disk, disk_targets) for disk_targets in disks.values()]:
+            result.result()
+    if encrypt_pool:
+        encrypt_pool.shutdown()
     print("done unpacking, to extract with depot_extractor you will need these manifests:")
     for depot, manifest in need_manifests.items():
         print("depot %s manifest %s" % (depot, manifest))